@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+
+"""
+Measures how long the bin/ scripts take to start, by running each with
+--help under python -X importtime. Exits non-zero if a script loads one of
+the heavy optional modules at startup or takes longer than --max-ms, so
+startup regressions get caught before they reach every Nextflow task.
+"""
+
+import os
+import sys
+import time
+import argparse
+import subprocess
+
+BIN_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'bin')
+
+#scripts that only parse their arguments before doing any work
+SCRIPTS = ['submit_ncbi.py', 'submit_genbank.py']
+
+#modules that should only be imported by the code paths that use them
+HEAVY_MODULES = ['pandas', 'numpy', 'lxml', 'xmlschema', 'google', 'requests', 'ftplib']
+
+def import_times(script : str, repeats : int) -> tuple:
+    """
+    Runs a script with --help and returns the best wall time in ms and the
+    top level modules it imported with their cumulative import time in us.
+    """
+    best = None
+    modules = {}
+    for _ in range(repeats):
+        start = time.perf_counter()
+        result = subprocess.run([sys.executable, '-X', 'importtime', os.path.join(BIN_DIR, script), '--help'], \
+            stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+        elapsed = (time.perf_counter() - start) * 1000
+        if best is None or elapsed < best:
+            best = elapsed
+        for line in result.stderr.splitlines():
+            if not line.startswith('import time:') or 'cumulative' in line:
+                continue
+            _, cumulative, name = line[len('import time:'):].split('|')
+            modules[name.strip()] = int(cumulative)
+    return(best, modules)
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        '--max-ms',
+        type=float,
+        default=250,
+        help="Startup time over which a script fails."
+    )
+    parser.add_argument(
+        '--repeats',
+        type=int,
+        default=5,
+        help="Runs per script, the fastest is reported."
+    )
+    args = parser.parse_args()
+
+    failed = False
+    for script in SCRIPTS:
+        elapsed, modules = import_times(script, args.repeats)
+        heavy = sorted(set(m.split('.')[0] for m in modules) & set(HEAVY_MODULES))
+        slowest = sorted(((v, k) for k, v in modules.items() if '.' not in k), reverse=True)[:5]
+
+        print("%s: %.0f ms" %(script, elapsed))
+        for cumulative, name in slowest:
+            print("    %-20s %.1f ms" %(name, cumulative/1000))
+        if len(heavy) > 0:
+            print("    FAIL: imports %s at startup" %', '.join(heavy))
+            failed = True
+        if elapsed > args.max_ms:
+            print("    FAIL: over %.0f ms" %args.max_ms)
+            failed = True
+
+    if failed:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,223 @@
+#!/usr/bin/env python
+
+"""
+Builds the SRA metadata (ncbi_metadata.csv) and the GenBank source table
+(source.src) from the GISAID export and the lab metadata in a single pass,
+keeping the table in memory between the two.
+"""
+
+import os
+import argparse
+import pandas as pd
+
+AUTHOR_CONVERSIONS = '/home/alab/code/bjorn_utils/author_conversions.csv'
+
+GISAID_COLUMNS = {
+    'covv_subm_sample_id': 'ID',
+    'covv_collection_date': 'collection_date',
+    'covv_location': 'geo_loc_name',
+    'covv_virus_name': 'isolate',
+    'covv_specimen': 'isolation_source',
+    'covv_authors': 'collected_by_1',
+    'covv_orig_lab': 'collected_by_2'
+}
+
+# add biosample and sra once they are added as columns
+META_COLUMNS = ['ID', 'gisaid_accession', 'gb_accession', 'host']
+
+SRA_COLUMNS = ['sample_name', 'collection_date','geo_loc_name','isolate',
+    'isolation_source','collection_method','gisaid_accession',
+    'gisaid_virus_name','host','bioproject_accession','host_disease',
+    'collected_by','vaccine_received']
+
+SOURCE_COLUMNS = ["sequence_ID", "organism", "isolate", "country", "collection-date",
+    "host", "isolation-source", "BioProject", "Note"]
+
+#columns of ncbi_metadata.csv each consumer reads
+GENBANK_META_COLUMNS = ['sample_name', 'collection_date', 'geo_loc_name', 'gisaid_accession',
+    'gisaid_virus_name', 'host', 'collection_method']
+
+def sidecar_path(csv_path : str) -> str:
+    """
+    The Feather copy kept beside a metadata csv.
+    """
+    return(os.path.splitext(csv_path)[0] + '.feather')
+
+def write_meta(meta, csv_path : str):
+    """
+    Writes the metadata as a csv for people and the publishDir, and as a
+    Feather sidecar for the later stages if pyarrow is installed.
+    """
+    meta.to_csv(csv_path, index=False)
+    #built from the csv so it reads back exactly as the csv does, and written
+    #after it so a sidecar older than its csv is known to be stale
+    try:
+        pd.read_csv(csv_path, dtype=str).to_feather(sidecar_path(csv_path))
+    except ImportError:
+        pass
+
+def read_meta(csv_path : str, columns : list = None):
+    """
+    Reads only the given columns of the metadata, as text. The Feather
+    sidecar is used if it's at least as new as the csv and pyarrow is
+    installed, otherwise the csv is parsed. Nextflow stages the csv as a
+    link, so the sidecar is also looked for beside the file it points to.
+
+    Parameters
+    ----------
+    csv_path : str
+        Path to the metadata csv, such as ncbi_metadata.csv.
+    columns : list
+        The columns to read, all of them if None.
+
+    Returns
+    -------
+    meta : pd.DataFrame
+        The metadata, with missing values as NaN or None.
+    """
+    for path in [csv_path, os.path.realpath(csv_path)]:
+        sidecar = sidecar_path(path)
+        if os.path.exists(sidecar) and os.path.getmtime(sidecar) >= os.path.getmtime(path):
+            try:
+                return(pd.read_feather(sidecar, columns=columns))
+            except ImportError:
+                break
+    return(pd.read_csv(csv_path, usecols=columns, dtype=str))
+
+def sra_metadata(gisaid_meta_fp : str, bioproj : str, meta_fp : str, \
+    author_conversions_fp : str = AUTHOR_CONVERSIONS, chunksize : int = 100000):
+    """
+    Builds the SRA metadata for the samples in both the GISAID export
+    and the lab metadata.
+
+    Parameters
+    ----------
+    gisaid_meta_fp : str
+        Path to gisaid_metadata.csv from the bjorn folder.
+    bioproj : str
+        The bioproject accession.
+    meta_fp : str
+        Path to the lab metadata, in HCoV-19-Genomics format.
+    author_conversions_fp : str
+        Path to the table mapping GISAID authors to how they're credited.
+    chunksize : int
+        Rows of the GISAID export read at a time.
+
+    Returns
+    -------
+    meta : pd.DataFrame
+        The rows of ncbi_metadata.csv.
+    """
+    # only the lab metadata columns we use, everything read as text
+    meta = pd.read_csv(meta_fp, usecols=META_COLUMNS, dtype=str)[META_COLUMNS]
+    ids = set(meta['ID'])
+
+    # stream the gisaid export, keeping only the rows for samples in the lab metadata
+    chunks = []
+    for chunk in pd.read_csv(gisaid_meta_fp, usecols=list(GISAID_COLUMNS), dtype=str, chunksize=chunksize):
+        chunk = chunk.rename(columns = GISAID_COLUMNS)[list(GISAID_COLUMNS.values())]
+        chunks.append(chunk[chunk['ID'].isin(ids)])
+    gisaid_meta = pd.concat(chunks, ignore_index=True)
+
+    meta = meta[meta['ID'].isin(gisaid_meta['ID'])]
+    meta = meta[meta['host']!= "Environment"]
+    meta = meta.merge(gisaid_meta, how="left")
+
+    # replace geo loc name / with :
+    meta['geo_loc_name'] = meta['geo_loc_name'].str.replace('/',':', regex=False)
+
+    # add host = Homo Sapiens, host_disease = COVID-19, bioproject
+    meta['host'] = 'Homo Sapiens'
+    meta['host_disease'] = 'COVID-19'
+    meta['bioproject_accession'] = bioproj
+    # add vaccine_received = not collected
+    meta['vaccine_received'] = 'not collected'
+
+    author_conversions = pd.read_csv(author_conversions_fp, dtype=str)
+    meta = meta.merge(author_conversions, how="left", left_on="collected_by_1", right_on="authors_original")
+    meta = meta.drop(columns=["collected_by_1", "authors_original"])
+    meta = meta.rename(columns={"authors_new": "collected_by_1"})
+
+    # join both fields if we have them, otherwise take whichever one we have
+    has_first_field = meta["collected_by_1"].notna()
+    has_second_field = meta["collected_by_2"].notna()
+    meta["collected_by"] = (meta["collected_by_1"] + " with the help of " + meta["collected_by_2"]) \
+        .fillna(meta["collected_by_1"]).fillna(meta["collected_by_2"]).fillna("Unknown")
+
+    # keep the rows grouped as both fields, the first, the second, then neither
+    group = 3 - 2*has_first_field.astype(int) - has_second_field.astype(int)
+    meta = meta.iloc[group.to_numpy().argsort(kind="stable")]
+
+    # drop defunct columns
+    meta = meta.drop(columns=["collected_by_1", "collected_by_2"])
+
+    meta = meta[~meta["collected_by"].str.contains("Helix")]
+    # dump out the dataframe of sequences that need to be uploaded
+    meta = meta.fillna("not collected")
+    try:
+        meta["collection_date"] = pd.to_datetime(meta["collection_date"], format='%Y-%m-%d').dt.strftime('%Y-%m-%d')
+    except ValueError:
+        # partial or otherwise formatted dates
+        meta["collection_date"] = pd.to_datetime(meta["collection_date"]).dt.strftime('%Y-%m-%d')
+    meta["isolate"] = meta["isolate"].str.replace("N/A", "not collected", regex=False)
+    meta["sample_name"] = meta["ID"]
+    meta["collection_method"] = meta["isolation_source"]
+    meta["gisaid_virus_name"] = meta["isolate"]
+    return(meta[SRA_COLUMNS])
+
+def genbank_source(meta):
+    """
+    Builds the GenBank source table from the SRA metadata.
+
+    Parameters
+    ----------
+    meta : pd.DataFrame
+        The SRA metadata, as built by sra_metadata or read from ncbi_metadata.csv.
+
+    Returns
+    -------
+    source : pd.DataFrame
+        The rows of source.src.
+    """
+    source = pd.DataFrame({
+        "sequence_ID": meta["sample_name"],
+        "organism": "Severe acute respiratory syndrome coronavirus 2",
+        "isolate": meta["gisaid_virus_name"].str.replace("hCoV-19", "SARS-CoV-2/human", regex=False),
+        "country": meta["geo_loc_name"].str.split(':').str[1],
+        "collection-date": meta["collection_date"],
+        "host": meta["host"].str.replace("Human", "Homo Sapiens", regex=False),
+        "isolation-source": meta["collection_method"],
+        "BioProject": "PRJNA612578",
+        "Note": meta["gisaid_accession"],
+    })
+    source.loc[source["country"] == "MEX", "country"] = "Mexico"
+    source = source[SOURCE_COLUMNS].fillna('')
+
+    # the isolate ends with the collection year rather than the year in the virus name
+    year = source["collection-date"].astype(str).str.split('-').str[0]
+    source["isolate"] = source["isolate"].astype(str).str.rpartition('/')[0] + '/' + year
+    return(source)
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('gisaid_meta', help="Path to gisaid_metadata.csv.")
+    parser.add_argument('bioproject', help="The bioproject accession.")
+    parser.add_argument('metadata', help="Path to the lab metadata.")
+    parser.add_argument(
+        '--sra-out',
+        default="ncbi_metadata.csv",
+        help="Where to write the SRA metadata."
+    )
+    parser.add_argument(
+        '--source-out',
+        default="source.src",
+        help="Where to write the GenBank source table."
+    )
+    args = parser.parse_args()
+
+    meta = sra_metadata(args.gisaid_meta, args.bioproject, args.metadata)
+    write_meta(meta, args.sra_out)
+    genbank_source(meta).to_csv(args.source_out, sep="\t", index=False)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,167 @@
+#!/usr/bin/env python
+
+"""
+Writes md5 checksums for the files in the upload folders, such as the staged
+BAMs, the GenBank zips and submission.xml. Files are hashed in a thread pool
+through mmap, and the manifest is kept across runs keyed by path, size and
+mtime so unchanged files are never hashed again. Hard links to a file that
+was already hashed, such as the same BAM staged for a later run, reuse its
+checksum by inode. Files with the same checksum are reported as duplicates.
+"""
+
+import os
+import mmap
+import hashlib
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+
+#bytes hashed per update, large enough that hashlib releases the GIL
+HASH_BLOCK = 1 << 23
+
+#files hashed when a folder is given
+EXTENSIONS = ('.bam', '.zip', '.xml')
+
+MANIFEST_COLUMNS = ['path', 'size', 'mtime_ns', 'device', 'inode', 'md5']
+
+def mmap_md5(path):
+    """
+    Returns the hex md5 of a file, read through a memory map.
+    """
+    md5 = hashlib.md5()
+    with open(path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size > 0:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+                view = memoryview(m)
+                for start in range(0, len(m), HASH_BLOCK):
+                    md5.update(view[start:start+HASH_BLOCK])
+                view.release()
+    return(md5.hexdigest())
+
+def read_manifest(manifest_path):
+    """
+    Reads a manifest into a dict of path to its row.
+    """
+    rows = {}
+    if not os.path.exists(manifest_path):
+        return(rows)
+    with open(manifest_path) as f:
+        header = f.readline().rstrip('\n').split('\t')
+        for line in f:
+            row = dict(zip(header, line.rstrip('\n').split('\t')))
+            for key in ['size', 'mtime_ns', 'device', 'inode']:
+                row[key] = int(row[key])
+            rows[row['path']] = row
+    return(rows)
+
+def write_manifest(manifest_path, rows):
+    """
+    Writes the manifest sorted by path, replacing the old one only once
+    it's complete.
+    """
+    tmp_path = manifest_path + '.%s.part' %os.getpid()
+    with open(tmp_path, 'w') as f:
+        f.write('\t'.join(MANIFEST_COLUMNS) + '\n')
+        for path in sorted(rows):
+            f.write('\t'.join(str(rows[path][x]) for x in MANIFEST_COLUMNS) + '\n')
+    os.replace(tmp_path, manifest_path)
+
+def list_files(paths, extensions=EXTENSIONS):
+    """
+    Expands folders into the files in them with the given extensions,
+    files given directly are kept whatever their extension.
+    """
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            for root, _, filenames in os.walk(path):
+                files.extend(os.path.join(root, x) for x in sorted(filenames) if x.endswith(extensions))
+        else:
+            files.append(path)
+    return([os.path.abspath(x) for x in files])
+
+def update_manifest(files, rows, workers=8):
+    """
+    Brings the manifest rows for files up to date, hashing only those whose
+    path, size and mtime, or inode, aren't already in the manifest.
+
+    Parameters
+    ----------
+    files : list
+        Absolute paths of the files to checksum.
+    rows : dict
+        The manifest from read_manifest, updated in place.
+    workers : int
+        Number of files hashed at once.
+
+    Returns
+    -------
+    hashed : int
+        The number of files that had to be hashed.
+    """
+    by_inode = {(x['device'], x['inode'], x['size'], x['mtime_ns']): x['md5'] for x in rows.values()}
+    to_hash = []
+    for path in files:
+        st = os.stat(path)
+        row = {'path': path, 'size': st.st_size, 'mtime_ns': st.st_mtime_ns, \
+            'device': st.st_dev, 'inode': st.st_ino}
+        old = rows.get(path)
+        if old is not None and old['size'] == row['size'] and old['mtime_ns'] == row['mtime_ns']:
+            row['md5'] = old['md5']
+        else:
+            row['md5'] = by_inode.get((row['device'], row['inode'], row['size'], row['mtime_ns']))
+            if row['md5'] is None:
+                to_hash.append(row)
+        rows[path] = row
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for row, md5 in zip(to_hash, executor.map(mmap_md5, [x['path'] for x in to_hash])):
+            row['md5'] = md5
+    return(len(to_hash))
+
+def duplicates(rows, files):
+    """
+    Groups the files by checksum, returning the groups with more than one
+    distinct file.
+    """
+    groups = {}
+    for path in files:
+        row = rows[path]
+        groups.setdefault(row['md5'], {})[(row['device'], row['inode'])] = path
+    return([sorted(x.values()) for x in groups.values() if len(x) > 1])
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        'paths',
+        nargs='+',
+        help="Files or folders to checksum, folders are searched for %s files." %', '.join(EXTENSIONS)
+    )
+    parser.add_argument(
+        '-m',
+        '--manifest',
+        default="checksums.tsv",
+        help="Manifest to reuse and update."
+    )
+    parser.add_argument(
+        '-w',
+        '--workers',
+        type=int,
+        default=8,
+        help="Number of files hashed at once."
+    )
+    args = parser.parse_args()
+
+    rows = read_manifest(args.manifest)
+    #forget files that no longer exist
+    rows = {x: y for x, y in rows.items() if os.path.exists(x)}
+
+    files = list_files(args.paths)
+    hashed = update_manifest(files, rows, args.workers)
+    write_manifest(args.manifest, rows)
+    print("Checksummed %s files, %s hashed and %s reused" %(len(files), hashed, len(files) - hashed))
+
+    for group in duplicates(rows, files):
+        print("Duplicate files: %s" %', '.join(group))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,129 @@
+#!/usr/bin/env python
+
+"""
+Checks consensus sequences before GenBank packaging. Computes the length,
+N fraction and number of characters other than ACGTN for every record, and
+splits the records into passing and failing fastas with a per-sample table.
+"""
+
+import argparse
+import numpy as np
+from convert_fasta_id import BUFFER_SIZE, iter_records
+
+# sequence bytes checked at a time
+CHUNK_BYTES = 1 << 24
+
+# 0 for ACGT, 1 for N and 2 for anything else, either case
+BASE_CLASS = np.full(256, 2, dtype=np.uint8)
+for base in b'ACGTacgt':
+    BASE_CLASS[base] = 0
+for base in b'Nn':
+    BASE_CLASS[base] = 1
+
+def iter_chunks(records, chunk_bytes=CHUNK_BYTES):
+    """
+    Groups records into lists holding about chunk_bytes of sequence.
+    """
+    chunk = []
+    size = 0
+    for record in records:
+        chunk.append(record)
+        size += len(record[1])
+        if size >= chunk_bytes:
+            yield chunk
+            chunk = []
+            size = 0
+    if len(chunk) > 0:
+        yield chunk
+
+def sequence_stats(seqs):
+    """
+    Computes the length, N count and count of non-ACGTN characters of each
+    sequence, over all of them at once.
+
+    Parameters
+    ----------
+    seqs : list
+        The sequences as bytes.
+
+    Returns
+    -------
+    lengths, n_counts, other_counts : np.ndarray
+        One value per sequence.
+    """
+    lengths = np.fromiter((len(x) for x in seqs), dtype=np.int64, count=len(seqs))
+    classes = BASE_CLASS.take(np.frombuffer(b''.join(seqs), dtype=np.uint8))
+    n_counts = np.zeros_like(lengths)
+    other_counts = np.zeros_like(lengths)
+
+    # sum each sequence's slice, empty ones are left out as reduceat can't give them 0
+    nonempty = lengths > 0
+    if nonempty.any():
+        starts = (np.cumsum(lengths) - lengths)[nonempty]
+        n_counts[nonempty] = np.add.reduceat((classes == 1).view(np.uint8), starts, dtype=np.int64)
+        other_counts[nonempty] = np.add.reduceat(classes >> 1, starts, dtype=np.int64)
+    return lengths, n_counts, other_counts
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('fasta', help="Fasta of consensus sequences, such as sequences.reformat.fsa.")
+    parser.add_argument(
+        '--min-length',
+        type=int,
+        default=20000,
+        help="Shortest sequence that passes."
+    )
+    parser.add_argument(
+        '--max-n-fraction',
+        type=float,
+        default=0.5,
+        help="Largest fraction of Ns that passes."
+    )
+    parser.add_argument(
+        '--max-ambiguous',
+        type=int,
+        default=100,
+        help="Most characters other than ACGTN that pass."
+    )
+    parser.add_argument('--pass-out', default="sequences.pass.fsa", help="Fasta of passing sequences.")
+    parser.add_argument('--fail-out', default="sequences.fail.fsa", help="Fasta of failing sequences.")
+    parser.add_argument('--qc-out', default="consensus_qc.tsv", help="Per-sample QC table.")
+    args = parser.parse_args()
+
+    n_pass = 0
+    n_fail = 0
+    with open(args.pass_out, 'wb', buffering=BUFFER_SIZE) as pass_f, \
+        open(args.fail_out, 'wb', buffering=BUFFER_SIZE) as fail_f, \
+        open(args.qc_out, 'w', buffering=BUFFER_SIZE) as qc_f:
+        qc_f.write("sample\tlength\tn_fraction\tambiguous\tstatus\treason\n")
+
+        for chunk in iter_chunks(iter_records(args.fasta)):
+            lengths, n_counts, other_counts = sequence_stats([x[1] for x in chunk])
+            n_fractions = n_counts / np.maximum(lengths, 1)
+            too_short = lengths < args.min_length
+            too_many_n = n_fractions > args.max_n_fraction
+            too_ambiguous = other_counts > args.max_ambiguous
+            passed = ~(too_short | too_many_n | too_ambiguous)
+
+            for i, (header, seq) in enumerate(chunk):
+                reasons = []
+                if too_short[i]:
+                    reasons.append("length")
+                if too_many_n[i]:
+                    reasons.append("n_fraction")
+                if too_ambiguous[i]:
+                    reasons.append("ambiguous")
+
+                if passed[i]:
+                    pass_f.write(b"%s\n%s\n" %(header, seq))
+                    n_pass += 1
+                else:
+                    fail_f.write(b"%s\n%s\n" %(header, seq))
+                    n_fail += 1
+                qc_f.write("%s\t%s\t%.4f\t%s\t%s\t%s\n" %(header[1:].decode(), lengths[i], n_fractions[i], \
+                    other_counts[i], "pass" if passed[i] else "fail", ",".join(reasons)))
+
+    print("%s sequences passed QC, %s failed" %(n_pass, n_fail))
+
+if __name__ == "__main__":
+    main()
@@ -1,23 +1,147 @@
 #!/usr/bin/env python
 
-import sys
+import os
+import locale
+import argparse
 
-fasta = sys.argv[1]
+# bytes buffered per read and write
+BUFFER_SIZE = 1 << 20
 
 def process_id(x):
-    if not x.startswith("SEARCH"):
-        start = x.index("SEARCH")
+    x = x.lstrip('>')
+    start = x.index("SEARCH")
     return x[start:].split('/')[0]
     # return ''.join(x.split('-')[-2:])
 
-fasta_dict = {}
-with open(fasta, 'r') as f:
+def index_records(fasta):
+    """
+    Scans the fasta once and maps each ID to the offset of the sequence of
+    its last record, in the order the IDs first appear. Records without any
+    sequence are skipped.
+    """
+    offsets = {}
+    with open(fasta, 'rb', buffering=BUFFER_SIZE) as f:
+        id = None
+        has_seq = False
+        offset = 0
+        for line in f:
+            offset += len(line)
+            if line.startswith(b'>'):
+                if id is not None and has_seq:
+                    offsets[id] = seq_offset
+                id = process_id(line.decode().strip())
+                seq_offset = offset
+                has_seq = False
+            elif line.strip():
+                has_seq = True
+        if id is not None and has_seq:
+            offsets[id] = seq_offset
+    return offsets
+
+def read_sequence(f):
+    """
+    Reads from the current position of a fasta up to the next header. Returns
+    the sequence joined onto one line and that header, or b'' at the end of
+    the file.
+    """
+    seq = []
     for line in f:
-        if line.startswith('>'):
-            id = process_id(line.strip())
-        else:
-            fasta_dict[id] = line.strip()
-
-with open('sequences.reformat.fsa', 'w') as f:
-    for id, seq in fasta_dict.items():
-        f.write(f">{id}\n{seq}\n")
\ No newline at end of file
+        if line.startswith(b'>'):
+            return b''.join(seq), line
+        seq.append(line.strip())
+    return b''.join(seq), b''
+
+def iter_records(fasta):
+    """
+    Yields the header line and the sequence, joined onto one line, of each record.
+    """
+    with open(fasta, 'rb', buffering=BUFFER_SIZE) as f:
+        _, header = read_sequence(f)
+        while header:
+            seq, next_header = read_sequence(f)
+            yield header.strip(), seq
+            header = next_header
+
+def iter_sequences(fasta, offsets):
+    """
+    Yields each ID and its sequence joined onto one line, reading only
+    the record being yielded.
+    """
+    with open(fasta, 'rb', buffering=BUFFER_SIZE) as f:
+        for id, offset in offsets.items():
+            f.seek(offset)
+            yield id, read_sequence(f)[0]
+
+def read_record(path, offset):
+    """
+    Reads the sequence starting at offset in a fasta, joined onto one line.
+    """
+    with open(path, 'rb', buffering=BUFFER_SIZE) as f:
+        f.seek(offset)
+        return read_sequence(f)[0]
+
+def glob_order(paths):
+    """
+    Sorts paths the way the shell orders a glob, by the collation of the
+    current locale.
+    """
+    locale.setlocale(locale.LC_COLLATE, '')
+    return sorted(paths, key=locale.strxfrm)
+
+def index_dir(consensus_dir, workers):
+    """
+    Indexes every fasta in a directory with a thread pool, reading only the
+    headers into memory. IDs are merged in glob order as if the files had
+    been concatenated, mapping each ID to the file and offset of its last
+    record.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+    paths = glob_order(os.path.join(consensus_dir, x) for x in os.listdir(consensus_dir) \
+        if not x.startswith('.') and os.path.isfile(os.path.join(consensus_dir, x)))
+    offsets = {}
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for path, file_offsets in zip(paths, executor.map(index_records, paths)):
+            for id, offset in file_offsets.items():
+                offsets[id] = (path, offset)
+    return offsets
+
+def iter_dir_sequences(offsets, workers, window=256):
+    """
+    Yields each ID and its sequence from index_dir, reading the records
+    a window at a time with a thread pool.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+    records = list(offsets.items())
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for start in range(0, len(records), window):
+            chunk = records[start:start+window]
+            seqs = executor.map(lambda x: read_record(*x[1]), chunk)
+            for (id, _), seq in zip(chunk, seqs):
+                yield id, seq
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        'fasta',
+        help="Fasta of consensus sequences, or a directory of them such as msa/consensus_sequences."
+    )
+    parser.add_argument(
+        '-w',
+        '--workers',
+        type=int,
+        default=8,
+        help="Number of files to read at once when given a directory."
+    )
+    args = parser.parse_args()
+
+    if os.path.isdir(args.fasta):
+        sequences = iter_dir_sequences(index_dir(args.fasta, args.workers), args.workers)
+    else:
+        sequences = iter_sequences(args.fasta, index_records(args.fasta))
+
+    with open('sequences.reformat.fsa', 'wb', buffering=BUFFER_SIZE) as f:
+        for id, seq in sequences:
+            f.write(b">%s\n%s\n" %(id.encode(), seq))
+
+if __name__ == "__main__":
+    main()
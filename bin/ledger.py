@@ -0,0 +1,285 @@
+#!/usr/bin/env python
+
+"""
+A SQLite ledger of what has been submitted for each sample: its BioSample
+and SRA SPUIDs, batch, metadata checksum, BAM size and mtime, BioSample, SRA and GenBank
+accessions and its SRA and GenBank status. Metadata conversion, BAM
+staging and XML generation each look their samples up in one query, so a
+run only carries samples that are new, changed or not yet submitted.
+
+Samples move through the statuses pending (in the converted metadata),
+staged, failed or missing (BAM staging), xml or invalid (in a
+submission.xml), uploaded (sent to NCBI) and submitted or rejected, which
+are only set once a submission is known to have gone through or failed,
+either by hand with `ledger.py LEDGER mark submitted` or from the NCBI
+reports. Samples in xml or uploaded are in flight and left out of later
+runs like submitted ones, so only rejected and invalid samples, and those
+that never made it into a submission.xml, are sent again. A submission.xml
+that was never uploaded can be released with `ledger.py LEDGER mark pending
+--submission submission.xml`. GenBank is tracked on its own: a sample's
+sequence is left out of later GenBank packages once it has a GenBank
+accession or its genbank_status is submitted, whatever happened to its
+SRA submission.
+
+    ledger.py submission_ledger.sqlite filter-meta ncbi_metadata.csv source.src -m metadata.csv
+    ledger.py submission_ledger.sqlite filter-fasta sequences.pass.fsa
+    ledger.py submission_ledger.sqlite mark uploaded --submission sra_2021-07-01/submission.xml
+    ledger.py submission_ledger.sqlite mark submitted --batch hcov-19_submission_2021-07-01_0_8000
+    ledger.py submission_ledger.sqlite mark submitted --genbank --samples SEARCH-1234
+    ledger.py submission_ledger.sqlite show
+"""
+
+import os
+import sys
+import sqlite3
+import hashlib
+import argparse
+from datetime import datetime
+
+LEDGER_COLUMNS = ['sample_name', 'spuid', 'sra_spuid', 'batch', 'checksum', 'bam_signature', 'biosample_accession', \
+    'sra_accession', 'genbank_accession', 'status', 'genbank_status', 'updated']
+
+#samples in these statuses are left out of later runs unless their metadata changes
+DONE_STATUSES = ('submitted',)
+
+#samples in a submission that hasn't been reported on yet, also left out of later runs
+IN_FLIGHT_STATUSES = ('xml', 'uploaded')
+
+def open_ledger(path):
+    """
+    Opens the ledger, creating it if needed and adding any columns a ledger
+    written by an older version is missing.
+    """
+    conn = sqlite3.connect(path, timeout=60)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("CREATE TABLE IF NOT EXISTS samples (sample_name TEXT PRIMARY KEY, %s)" \
+        %', '.join("%s TEXT" %x for x in LEDGER_COLUMNS[1:]))
+    existing = set(x[1] for x in conn.execute("PRAGMA table_info(samples)"))
+    with conn:
+        for column in LEDGER_COLUMNS:
+            if column not in existing:
+                conn.execute("ALTER TABLE samples ADD COLUMN %s TEXT" %column)
+    conn.execute("CREATE INDEX IF NOT EXISTS samples_batch ON samples (batch)")
+    return(conn)
+
+def fetch(conn, sample_names):
+    """
+    Looks up the ledger rows for many samples in one query.
+
+    Returns
+    -------
+    rows : dict
+        Sample name to its row as a dict, for the samples in the ledger.
+    """
+    conn.execute("CREATE TEMP TABLE IF NOT EXISTS wanted (sample_name TEXT PRIMARY KEY)")
+    conn.execute("DELETE FROM wanted")
+    conn.executemany("INSERT OR IGNORE INTO wanted VALUES (?)", ((x,) for x in sample_names))
+    cursor = conn.execute("SELECT %s FROM samples JOIN wanted USING (sample_name)" %', '.join(LEDGER_COLUMNS))
+    return({x[0]: dict(zip(LEDGER_COLUMNS, x)) for x in cursor})
+
+def record(conn, rows):
+    """
+    Inserts or updates the given columns of many samples, leaving their
+    other columns as they were.
+
+    Parameters
+    ----------
+    rows : list
+        Dicts holding sample_name and the columns to set.
+    """
+    updated = datetime.now().isoformat(timespec='seconds')
+    groups = {}
+    for row in rows:
+        columns = tuple(x for x in LEDGER_COLUMNS if x in row and x not in ('sample_name', 'updated'))
+        groups.setdefault(columns, []).append(row)
+    with conn:
+        for columns, group in groups.items():
+            names = ('sample_name',) + columns + ('updated',)
+            sql = "INSERT INTO samples (%s) VALUES (%s) ON CONFLICT (sample_name) DO UPDATE SET %s" \
+                %(', '.join(names), ', '.join('?' * len(names)), \
+                ', '.join("%s = excluded.%s" %(x, x) for x in names[1:]))
+            conn.executemany(sql, ([x['sample_name']] + [x[c] for c in columns] + [updated] for x in group))
+
+def submission_samples(conn, xml_path):
+    """
+    The samples in a submission.xml, matched by the BioSample and SRA SPUIDs
+    the ledger has for them.
+    """
+    import xml.etree.ElementTree as ET
+    spuids = set()
+    for _, elem in ET.iterparse(xml_path):
+        if elem.tag == 'SPUID' and elem.text:
+            spuids.add(elem.text.strip())
+        elif elem.tag == 'Action':
+            elem.clear()
+    return([x[0] for x in conn.execute("SELECT sample_name, spuid, sra_spuid FROM samples") \
+        if x[1] in spuids or x[2] in spuids])
+
+def genbank_done(row):
+    """
+    Whether a ledger row's sequence is already in GenBank or submitted to it.
+    """
+    return(bool(row['genbank_accession']) or row['genbank_status'] in DONE_STATUSES)
+
+def row_checksum(values):
+    """
+    The md5 of a metadata row, used to tell when a sample's metadata changed.
+    """
+    return(hashlib.md5('\t'.join(values).encode()).hexdigest())
+
+def filter_meta(conn, meta, lab_meta=None):
+    """
+    Picks the samples still to send to the SRA, those neither in flight nor
+    already submitted with the same metadata, and records them as pending.
+    Separately picks
+    the samples still to send to GenBank, those without a GenBank accession
+    or submission, after recording the GenBank accessions from the lab
+    metadata.
+
+    Parameters
+    ----------
+    meta : pd.DataFrame
+        ncbi_metadata.csv, read as text.
+    lab_meta : pd.DataFrame
+        The lab metadata's ID and gb_accession columns, if available.
+
+    Returns
+    -------
+    keep : pd.Series
+        Whether each row of meta is new, changed or rejected, for the SRA.
+    keep_genbank : pd.Series
+        Whether each row of meta still needs to go to GenBank.
+    """
+    checksums = [row_checksum(x) for x in meta.itertuples(index=False, name=None)]
+    names = list(meta['sample_name'])
+
+    if lab_meta is not None:
+        accessions = lab_meta.dropna()
+        accessions = accessions[accessions['ID'].isin(set(names))]
+        record(conn, [{'sample_name': x, 'genbank_accession': y} for x, y in \
+            zip(accessions['ID'], accessions['gb_accession'])])
+    known = fetch(conn, names)
+
+    keep = []
+    pending = []
+    in_flight = 0
+    for name, checksum in zip(names, checksums):
+        row = known.get(name)
+        #a changed sample waits for its submission in flight, and is picked up once it's reported on
+        if row is not None and row['status'] in IN_FLIGHT_STATUSES:
+            keep.append(False)
+            in_flight += 1
+        elif row is None or row['checksum'] != checksum or row['status'] not in DONE_STATUSES:
+            keep.append(True)
+            pending.append({'sample_name': name, 'checksum': checksum, 'status': 'pending'})
+        else:
+            keep.append(False)
+    record(conn, pending)
+    genbank_names = set(x for x in names if x not in known or not genbank_done(known[x]))
+
+    print("%s of %s samples are new or changed, %s are in flight" %(sum(keep), len(keep), in_flight))
+    print("%s of %s samples still need to go to GenBank" %(len(genbank_names), len(keep)))
+    return(meta['sample_name'].isin(set(x for x, y in zip(names, keep) if y)), \
+        meta['sample_name'].isin(genbank_names))
+
+def filter_fasta(conn, fasta):
+    """
+    Drops the records of samples the ledger has in GenBank from a fasta,
+    in place.
+
+    Returns
+    -------
+    kept, dropped : int
+        The number of records kept and dropped.
+    """
+    ids = []
+    with open(fasta, 'rb') as f:
+        for line in f:
+            if line.startswith(b'>'):
+                ids.append(line[1:].split()[0].decode())
+    done = set(x for x, y in fetch(conn, ids).items() if genbank_done(y))
+
+    kept = 0
+    tmp_path = fasta + '.%s.part' %os.getpid()
+    with open(fasta, 'rb') as f, open(tmp_path, 'wb') as out:
+        write = False
+        for line in f:
+            if line.startswith(b'>'):
+                write = line[1:].split()[0].decode() not in done
+                kept += write
+            if write:
+                out.write(line)
+    os.replace(tmp_path, fasta)
+    return(kept, len(ids) - kept)
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('ledger', help="Path to the ledger, created if missing.")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    filter_parser = subparsers.add_parser('filter-meta', \
+        help="Keep only new or changed samples in ncbi_metadata.csv, and samples not yet in GenBank \
+        in source.src, in place.")
+    filter_parser.add_argument('sra_meta', help="Path to ncbi_metadata.csv.")
+    filter_parser.add_argument('source', nargs='?', help="Path to source.src.")
+    filter_parser.add_argument('-m', '--metadata', help="The lab metadata, for its GenBank accessions.")
+
+    fasta_parser = subparsers.add_parser('filter-fasta', \
+        help="Drop the sequences of samples already in GenBank from a fasta, in place.")
+    fasta_parser.add_argument('fasta', help="Path to the fasta.")
+
+    mark_parser = subparsers.add_parser('mark', help="Set the status of a batch or of samples.")
+    mark_parser.add_argument('status', help="The new status, such as submitted.")
+    mark_parser.add_argument('--batch', help="The action_name of the batch.")
+    mark_parser.add_argument('--samples', nargs='+', default=[], help="Sample names.")
+    mark_parser.add_argument('--submission', help="A submission.xml, for the samples in it.")
+    mark_parser.add_argument('--genbank', action='store_true', help="Set the GenBank status instead.")
+
+    show_parser = subparsers.add_parser('show', help="Print the ledger as a tsv.")
+    show_parser.add_argument('--status', help="Only samples with this status.")
+    args = parser.parse_args()
+
+    conn = open_ledger(args.ledger)
+
+    if args.command == 'filter-meta':
+        import pandas as pd
+        from build_meta import write_meta
+        meta = pd.read_csv(args.sra_meta, dtype=str, keep_default_na=False)
+        lab_meta = None
+        if args.metadata is not None:
+            lab_meta = pd.read_csv(args.metadata, usecols=['ID', 'gb_accession'], dtype=str)
+        keep, keep_genbank = filter_meta(conn, meta, lab_meta)
+        names = set(meta.loc[keep_genbank, 'sample_name'])
+        write_meta(meta[keep], args.sra_meta)
+        if args.source is not None:
+            source = pd.read_csv(args.source, sep='\t', dtype=str, keep_default_na=False)
+            source[source['sequence_ID'].isin(names)].to_csv(args.source, sep='\t', index=False)
+
+    elif args.command == 'filter-fasta':
+        kept, dropped = filter_fasta(conn, args.fasta)
+        print("Kept %s sequences, dropped %s already in GenBank" %(kept, dropped))
+
+    elif args.command == 'mark':
+        names = list(args.samples)
+        if args.batch is not None:
+            names += [x[0] for x in conn.execute("SELECT sample_name FROM samples WHERE batch = ?", (args.batch,))]
+        if args.submission is not None:
+            names += submission_samples(conn, args.submission)
+        column = 'genbank_status' if args.genbank else 'status'
+        record(conn, [{'sample_name': x, column: args.status} for x in names])
+        print("Marked %s samples %s %s" %(len(names), 'GenBank' if args.genbank else 'SRA', args.status))
+
+    elif args.command == 'show':
+        sql = "SELECT %s FROM samples" %', '.join(LEDGER_COLUMNS)
+        params = ()
+        if args.status is not None:
+            sql += " WHERE status = ?"
+            params = (args.status,)
+        sys.stdout.write('\t'.join(LEDGER_COLUMNS) + '\n')
+        for row in conn.execute(sql + " ORDER BY sample_name", params):
+            sys.stdout.write('\t'.join('' if x is None else str(x) for x in row) + '\n')
+
+    conn.close()
+
+if __name__ == "__main__":
+    main()
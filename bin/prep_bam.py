@@ -1,24 +1,247 @@
 #!/usr/bin/env python
-import pandas as pd
-import sys
+
+"""
+Stages the BAMs for the samples in ncbi_metadata.csv into the SRA upload
+folder. Only the matching BAMs from the source folders are hard linked, so
+reruns leave already staged files alone and only remove BAMs for samples
+that are no longer in the metadata. Each BAM is screened first, and ones
+that are truncated, corrupt or hold no reads are left out of the folder so
+submit_ncbi.py never puts them in submission.xml.
+"""
+
 import os
-import glob
+import zlib
+import struct
+import argparse
+from build_meta import read_meta
+from concurrent.futures import ThreadPoolExecutor
+
+#the empty block every complete BGZF file ends with
+BGZF_EOF = bytes.fromhex('1f8b08040000000000ff0600424302001b0003000000000000000000')
+
+BAM_MAGIC = b'BAM\x01'
+
+def bam_sample(filename):
+    """
+    The sample name a BAM belongs to, as matched by submit_ncbi.py.
+    """
+    return(filename.split('_')[0].split('.')[0])
+
+def find_bams(source_dirs):
+    """
+    Lists the BAMs in the source folders, mapping each filename to its
+    paths in folder order.
+    """
+    bams = {}
+    for source_dir in source_dirs:
+        if not os.path.isdir(source_dir):
+            print("Skipping missing folder %s" %source_dir)
+            continue
+        with os.scandir(source_dir) as it:
+            for entry in it:
+                if entry.name.endswith('.bam') and entry.is_file():
+                    bams.setdefault(entry.name, []).append(entry.path)
+    return(bams)
+
+def iter_blocks(f):
+    """
+    Yields the decompressed contents of each BGZF block from the current
+    position of f.
+    """
+    while True:
+        header = f.read(18)
+        if len(header) == 0:
+            return
+        if len(header) < 18 or header[:4] != b'\x1f\x8b\x08\x04' or header[12:14] != b'BC':
+            raise ValueError("bad BGZF block header")
+        block_size = struct.unpack('<H', header[16:18])[0] + 1
+        data = f.read(block_size - 18)
+        if len(data) < block_size - 18:
+            raise ValueError("truncated BGZF block")
+        yield zlib.decompress(data[:-8], -15)
+
+def check_bam(path):
+    """
+    Checks that a BAM ends with the BGZF EOF marker, starts with the BAM
+    magic and holds at least one read. Only the last 28 bytes and the
+    blocks up to the end of the header and the first read are read.
+
+    Returns
+    -------
+    reason : str
+        Why the BAM failed, or None if it passed.
+    """
+    try:
+        with open(path, 'rb') as f:
+            if os.fstat(f.fileno()).st_size < len(BGZF_EOF):
+                return("truncated")
+            f.seek(-len(BGZF_EOF), 2)
+            if f.read() != BGZF_EOF:
+                return("no EOF marker")
+            f.seek(0)
+
+            blocks = iter_blocks(f)
+            buf = bytearray()
+            def need(n):
+                #pull blocks until n bytes are buffered, False if the file ends first
+                while len(buf) < n:
+                    block = next(blocks, None)
+                    if block is None:
+                        return(False)
+                    buf.extend(block)
+                return(True)
+
+            if not need(4) or buf[:4] != BAM_MAGIC:
+                return("no BAM magic")
+            if not need(8):
+                return("truncated header")
+            pos = 8 + struct.unpack_from('<i', buf, 4)[0]
+            if not need(pos + 4):
+                return("truncated header")
+            n_ref = struct.unpack_from('<i', buf, pos)[0]
+            pos += 4
+            for _ in range(n_ref):
+                if not need(pos + 4):
+                    return("truncated header")
+                pos += 4 + struct.unpack_from('<i', buf, pos)[0] + 4
+            #the first read starts right after the references
+            if not need(pos + 4):
+                return("no reads")
+    except (OSError, ValueError, zlib.error) as e:
+        return("unreadable: %s" %e)
+    return(None)
+
+def link_bam(src, dest):
+    """
+    Hard links src to dest unless dest is already that file. Returns
+    whether a link was made.
+    """
+    if os.path.exists(dest):
+        if os.path.samefile(src, dest):
+            return(False)
+        os.remove(dest)
+    os.link(src, dest)
+    return(True)
+
+def stage_bams(sample_names, bam_folder, source_dirs, workers=8):
+    """
+    Links the BAMs of the samples into bam_folder and removes staged BAMs
+    of any other sample. Every copy of a sample's BAM is screened with
+    check_bam and the first that passes is linked, samples without one are
+    left out.
+
+    Parameters
+    ----------
+    sample_names : set
+        Samples in the metadata.
+    bam_folder : str
+        The SRA upload folder.
+    source_dirs : list
+        Folders the BAMs are linked from, such as bam_inspect and bam_white.
+    workers : int
+        Number of BAMs screened and linked at once.
+
+    Returns
+    -------
+    staged, missing, extra : list
+        Filenames linked or already in place, samples without a BAM and
+        BAMs in the source folders for samples not in the metadata.
+    failed : dict
+        Filenames of the BAMs that failed screening and why.
+    """
+    bams = find_bams(source_dirs)
+    wanted = {x: y for x, y in bams.items() if bam_sample(x) in sample_names}
+    extra = sorted(x for x in bams if x not in wanted)
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        paths = [y for x in wanted.values() for y in x]
+        reasons = dict(zip(paths, executor.map(check_bam, paths)))
+
+        sources = {}
+        failed = {}
+        for filename, candidates in wanted.items():
+            passing = [x for x in candidates if reasons[x] is None]
+            if len(passing) > 0:
+                sources[filename] = passing[0]
+            else:
+                failed[filename] = reasons[candidates[0]]
 
-ncbi_meta_fp = sys.argv[1]
-ncbi_meta = pd.read_csv(ncbi_meta_fp)
+        #drop BAMs staged for samples no longer in the metadata or that failed screening
+        for filename in os.listdir(bam_folder):
+            if filename.endswith('.bam') and (bam_sample(filename) not in sample_names or filename in failed):
+                os.remove(os.path.join(bam_folder, filename))
 
-bam_folder = sys.argv[2]
+        staged = sorted(sources)
+        linked = sum(executor.map(lambda x: link_bam(sources[x], os.path.join(bam_folder, x)), staged))
 
-bam_files = glob.glob(f"{bam_folder}/*.bam")
-for file in bam_files:
-    name = file.split('/')[-1].split('_')[0].split('.')[0]
-    if name not in list(ncbi_meta["sample_name"]):
-        cmd = 'rm %s' %(file)
-        os.system(cmd)
-    
+    found = set(bam_sample(x) for x in staged)
+    missing = sorted(sample_names - found - set(bam_sample(x) for x in failed))
+    print("Staged %s BAMs, %s newly linked, %s failed screening" %(len(staged), linked, len(failed)))
+    print("%s samples without a BAM, %s BAMs without metadata" %(len(missing), len(extra)))
+    return(staged, missing, extra, failed)
 
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('metadata', help="Path to ncbi_metadata.csv.")
+    parser.add_argument('bam_folder', help="The SRA upload folder.")
+    parser.add_argument(
+        'source_dirs',
+        nargs='*',
+        help="Folders to link BAMs from, such as bam_inspect and bam_white."
+    )
+    parser.add_argument(
+        '-w',
+        '--workers',
+        type=int,
+        default=8,
+        help="Number of BAMs screened and linked at once."
+    )
+    parser.add_argument(
+        '--report',
+        default="bam_staging.tsv",
+        help="Where to write the staged, failed, missing and extra samples."
+    )
+    parser.add_argument(
+        '--ledger',
+        help="Submission ledger, samples it has as submitted or in flight aren't staged."
+    )
+    args = parser.parse_args()
 
+    sample_names = set(read_meta(args.metadata, ['sample_name'])['sample_name'].dropna())
+    done = set()
+    if args.ledger is not None:
+        from ledger import open_ledger, fetch, record, DONE_STATUSES, IN_FLIGHT_STATUSES
+        conn = open_ledger(args.ledger)
+        done = set(x for x, y in fetch(conn, sample_names).items() \
+            if y['status'] in DONE_STATUSES + IN_FLIGHT_STATUSES)
+        sample_names -= done
+        print("Skipping %s samples already submitted or in flight" %len(done))
 
+    os.makedirs(args.bam_folder, exist_ok=True)
+    staged, missing, extra, failed = stage_bams(sample_names, args.bam_folder, args.source_dirs, args.workers)
+    extra = [x for x in extra if bam_sample(x) not in done]
 
+    if args.ledger is not None:
+        rows = []
+        for filename in staged:
+            st = os.stat(os.path.join(args.bam_folder, filename))
+            rows.append({'sample_name': bam_sample(filename), 'status': 'staged', \
+                'bam_signature': "%s:%s" %(st.st_size, st.st_mtime_ns)})
+        rows += [{'sample_name': bam_sample(x), 'status': 'failed'} for x in failed]
+        rows += [{'sample_name': x, 'status': 'missing'} for x in missing]
+        record(conn, rows)
+        conn.close()
 
+    with open(args.report, 'w') as f:
+        f.write("sample\tfile\tstatus\treason\n")
+        for filename in staged:
+            f.write("%s\t%s\tstaged\t\n" %(bam_sample(filename), filename))
+        for filename, reason in sorted(failed.items()):
+            f.write("%s\t%s\tfailed\t%s\n" %(bam_sample(filename), filename, reason))
+        for sample in missing:
+            f.write("%s\t\tmissing\t\n" %sample)
+        for filename in extra:
+            f.write("%s\t%s\textra\t\n" %(bam_sample(filename), filename))
 
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,201 @@
+#!/usr/bin/env python
+
+"""
+Runs a pipeline step through a local cache. The step's outputs are stored
+under a key hashed from its command, the bin/ scripts it runs, the contents
+of its input files and folders, the names and sizes of any listed folders
+and extra parameters such as the date. When the key is already cached the
+outputs are copied back instead of running the step, and the least recently
+used entries are evicted once the cache grows past --max-bytes.
+
+    step_cache.py -i gisaid_metadata.csv -o ncbi_metadata.csv -- build_meta.py ...
+"""
+
+import os
+import sys
+import glob
+import time
+import shutil
+import hashlib
+import argparse
+import subprocess
+from checksum_manifest import list_files, read_manifest, update_manifest, write_manifest
+
+CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'post_inspection_pipeline', 'steps')
+
+def script_files(command):
+    """
+    The python files beside the script a command runs, which it may import,
+    or nothing if the command isn't found.
+    """
+    path = shutil.which(command[0])
+    if path is None:
+        return([])
+    script_dir = os.path.dirname(os.path.realpath(path))
+    paths = [os.path.join(script_dir, x) for x in os.listdir(script_dir) if x.endswith('.py')]
+    return(sorted(x for x in paths if os.path.isfile(x)))
+
+def listing(folder):
+    """
+    The relative path and size of every file in a folder, or of the files
+    matching a glob such as bam_folder/*.bam, for inputs where only the
+    names and sizes matter.
+    """
+    if os.path.isdir(folder):
+        base = folder
+        paths = [os.path.join(root, x) for root, _, filenames in os.walk(folder) for x in filenames]
+    else:
+        base = os.path.dirname(folder)
+        paths = glob.glob(folder)
+    return(sorted("%s\t%s" %(os.path.relpath(x, base), os.path.getsize(x)) for x in paths))
+
+def step_key(command, inputs, listings, params, checksum_path):
+    """
+    Hashes everything a step's outputs depend on into its cache key. File
+    checksums are kept in checksum_path so unchanged inputs aren't hashed
+    again on later runs.
+    """
+    key = hashlib.sha256()
+    key.update('\0'.join(command).encode() + b'\n')
+    key.update('\0'.join(params).encode() + b'\n')
+
+    rows = read_manifest(checksum_path)
+    rows = {x: y for x, y in rows.items() if os.path.exists(x)}
+    groups = [(x, list_files([x], extensions=('',))) for x in inputs]
+    scripts = script_files(command)
+    update_manifest([y for _, x in groups for y in x] + scripts, rows)
+    write_manifest(checksum_path, rows)
+
+    for path in scripts:
+        key.update(("script\t%s\t%s\n" %(os.path.basename(path), rows[path]['md5'])).encode())
+    for input, files in groups:
+        base = os.path.abspath(input)
+        for path in files:
+            key.update(("input\t%s\t%s\n" %(os.path.relpath(path, base), rows[path]['md5'])).encode())
+    for folder in listings:
+        key.update(("listing\t%s\n" %folder).encode())
+        key.update('\n'.join(listing(folder)).encode())
+    return(key.hexdigest())
+
+def copy_path(src, dest):
+    """
+    Copies a file or folder, replacing whatever is at dest.
+    """
+    if os.path.isdir(dest):
+        shutil.rmtree(dest)
+    elif os.path.exists(dest):
+        os.remove(dest)
+    if os.path.isdir(src):
+        shutil.copytree(src, dest)
+    else:
+        shutil.copy2(src, dest)
+
+def entry_size(entry_dir):
+    """
+    Total bytes of the files in a cache entry.
+    """
+    return(sum(os.path.getsize(os.path.join(root, x)) for root, _, files in os.walk(entry_dir) for x in files))
+
+def evict(cache_dir, max_bytes):
+    """
+    Removes the least recently used entries until the cache fits in max_bytes.
+    """
+    entries = []
+    for name in os.listdir(cache_dir):
+        entry_dir = os.path.join(cache_dir, name)
+        if os.path.isdir(entry_dir) and not name.startswith('.'):
+            entries.append((os.path.getmtime(entry_dir), entry_size(entry_dir), entry_dir))
+    total = sum(x[1] for x in entries)
+    for _, size, entry_dir in sorted(entries):
+        if total <= max_bytes:
+            break
+        shutil.rmtree(entry_dir, ignore_errors=True)
+        total -= size
+        print("Evicted %s from the step cache" %os.path.basename(entry_dir))
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        '-i',
+        '--input',
+        action='append',
+        default=[],
+        help="File or folder whose contents the step reads, can be repeated."
+    )
+    parser.add_argument(
+        '-l',
+        '--listing',
+        action='append',
+        default=[],
+        help="Folder or glob the step only lists, keyed on its filenames and sizes, can be repeated."
+    )
+    parser.add_argument(
+        '-p',
+        '--param',
+        action='append',
+        default=[],
+        help="Extra value the outputs depend on, such as the date, can be repeated."
+    )
+    parser.add_argument(
+        '-o',
+        '--output',
+        action='append',
+        required=True,
+        help="File or folder the step writes to the cwd, can be repeated."
+    )
+    parser.add_argument(
+        '--cache-dir',
+        default=CACHE_DIR,
+        help="Where cached outputs are kept."
+    )
+    parser.add_argument(
+        '--max-bytes',
+        type=int,
+        default=20 * 1024**3,
+        help="Size the cache is evicted down to."
+    )
+    parser.add_argument('command', nargs=argparse.REMAINDER, help="The step to run, after --.")
+    args = parser.parse_args()
+
+    command = args.command[1:] if args.command[:1] == ['--'] else args.command
+    if len(command) == 0:
+        parser.error("no command given")
+
+    os.makedirs(args.cache_dir, exist_ok=True)
+    key = step_key(command, args.input, args.listing, args.param, \
+        os.path.join(args.cache_dir, '.input_checksums.tsv'))
+    entry_dir = os.path.join(args.cache_dir, key)
+
+    if os.path.isdir(entry_dir):
+        print("Step cache hit %s for %s" %(key[:12], os.path.basename(command[0])))
+        for output in args.output:
+            copy_path(os.path.join(entry_dir, os.path.basename(output)), output)
+        #mark the entry as recently used
+        now = time.time()
+        os.utime(entry_dir, (now, now))
+        return
+
+    print("Step cache miss %s for %s" %(key[:12], os.path.basename(command[0])))
+    result = subprocess.run(command)
+    if result.returncode != 0:
+        sys.exit(result.returncode)
+
+    missing = [x for x in args.output if not os.path.exists(x)]
+    if len(missing) > 0:
+        print("Not caching, the step didn't write %s" %', '.join(missing))
+        return
+
+    #build the entry beside the cache and move it in whole, so a partial entry is never used
+    tmp_dir = os.path.join(args.cache_dir, '.%s.%s' %(key, os.getpid()))
+    os.makedirs(tmp_dir)
+    for output in args.output:
+        copy_path(output, os.path.join(tmp_dir, os.path.basename(output)))
+    try:
+        os.rename(tmp_dir, entry_dir)
+    except OSError:
+        #another run cached the same step first
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+    evict(args.cache_dir, args.max_bytes)
+
+if __name__ == "__main__":
+    main()
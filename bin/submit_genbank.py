@@ -1,26 +1,13 @@
 #!/usr/bin/env python
 
 import os
-import ast
-import sys
-import json
-import pickle
-import ftplib
-import typing
-import requests
+import zipfile
 import argparse
-import xmlschema
-import pandas as pd
-import lxml.etree as et
-from copy import copy
-from math import isnan
-from google.cloud import storage
-import time
 from datetime import datetime
+from convert_fasta_id import BUFFER_SIZE
 
-def create_xml(out_dir, zip_file, xml_template):
-    cmd = 'touch %s/submission.xml' %(out_dir)
-    os.system(cmd)
+def create_xml(out_dir, zip_file, xml_template, spuid=None):
+    import lxml.etree as et
     submission_template_location = xml_template
     tree = et.parse(submission_template_location)
     root = tree.getroot() #submission level
@@ -34,67 +21,211 @@ def create_xml(out_dir, zip_file, xml_template):
     file_path.attrib['file_path'] = zip_file
     
     namespace = root.find("Action/AddFiles/Identifier/SPUID")
-    namespace.text = today_date + '.sarscov2'
+    namespace.text = spuid if spuid is not None else today_date + '.sarscov2'
     
-    tree.write("%s" %(out_dir + '/submission.xml'))
+    tree.write(os.path.join(out_dir, "submission.xml"))
     
-def write_fasta(fasta, outdir):    
-    # seqs = {}
-    
-    # with open(fasta, 'r') as f:
-    #     for line in f:
-    #         if line.startswith('>'):
-    #             key = line
-    #         else:
-    #             seqs[key] = line
-    # with open(outdir+'/sequences.fsa', 'w') as f:
-    #     for seq in seqs:
-    #         f.write('>' + seq + '\n')
-    #         f.write(seqs[seq])
-    cmd = 'cp %s %s' %(fasta,outdir)
-    os.system(cmd)
-                
-def zip_files(outdir, sbt):
-    cmd = 'cp %s %s' %(sbt, out_dir)
-    os.system(cmd)
-
-    cmd = 'zip genbank.zip *.fsa *.src *.sbt'
-    os.system(cmd)    
-    
-parser = argparse.ArgumentParser()
-
-parser.add_argument(
-    "-o",
-    "--out-dir",
-    type=str,
-    help="Path to output files for ncbi upload."
-)
-
-parser.add_argument(
-    "-f",
-    "--fasta",
-    type=str,
-    help="Fasta file with all sequences."
-)
-
-parser.add_argument(
-    '-s',
-    '--sbt-template',
-    help="Path to sbt template"
-)
-
-parser.add_argument(
-    '-x',
-    '--xml-template',
-    help="Path to xml template"
-)
-
-args = parser.parse_args()
-out_dir = args.out_dir
-fasta = args.fasta
-sbt_template = args.sbt_template
-xml_template = args.xml_template
-
-write_fasta(fasta, out_dir)
-zip_files(out_dir, sbt_template)
-create_xml(out_dir, 'genbank.zip', xml_template)
+def zip_files(out_dir, zip_name, paths, compression_level=6, data=None, ranges=None):
+    """
+    Writes the zip for upload straight from the input files, which zipfile
+    reads and compresses a fixed-size block at a time. A compression level
+    of 0 stores the files uncompressed. ranges maps entry names to a
+    (path, start, end) byte range of a file to copy in the same way, and
+    data maps the names of any small entries already held in memory to
+    their contents.
+    """
+    compression = zipfile.ZIP_STORED if compression_level == 0 else zipfile.ZIP_DEFLATED
+    zip_path = os.path.join(out_dir, zip_name)
+    with zipfile.ZipFile(zip_path, 'w', compression=compression, \
+        compresslevel=compression_level or None) as zf:
+        for path in paths:
+            zf.write(path, os.path.basename(path))
+        for name, (path, start, end) in (ranges or {}).items():
+            with open(path, 'rb') as src, \
+                zf.open(name, 'w', force_zip64=end - start >= zipfile.ZIP64_LIMIT) as dest:
+                src.seek(start)
+                remaining = end - start
+                while remaining > 0:
+                    block = src.read(min(BUFFER_SIZE, remaining))
+                    if not block:
+                        break
+                    dest.write(block)
+                    remaining -= len(block)
+        for name, contents in (data or {}).items():
+            zinfo = zipfile.ZipInfo(name, date_time=datetime.now().timetuple()[:6])
+            zf.writestr(zinfo, contents, compress_type=compression, \
+                compresslevel=compression_level or None)
+    return(zip_path)
+
+def plan_shards(fasta, shard_size):
+    """
+    Scans the fasta once and splits its records into runs of shard_size,
+    or keeps them all in one run if shard_size is 0.
+
+    Returns
+    -------
+    shards : list
+        (start, end, ids) per shard, the byte range of its records in the
+        fasta and their sequence IDs.
+    """
+    shards = []
+    ids = []
+    start = 0
+    offset = 0
+    with open(fasta, 'rb', buffering=BUFFER_SIZE) as f:
+        for line in f:
+            if line.startswith(b'>'):
+                if shard_size > 0 and len(ids) == shard_size:
+                    shards.append((start, offset, ids))
+                    ids = []
+                    start = offset
+                ids.append(line[1:].split()[0].decode())
+            offset += len(line)
+    if len(ids) > 0:
+        shards.append((start, offset, ids))
+    return(shards)
+
+def split_source(source, shards):
+    """
+    Splits the rows of the source table between the shards by sequence_ID,
+    keeping the header and the table's order in each. Rows of sequences not
+    in the fasta, such as those that failed QC, are dropped.
+
+    Returns
+    -------
+    tables : list
+        The source table for each shard, as bytes.
+    """
+    shard_of = {}
+    for i, (_, _, ids) in enumerate(shards):
+        for id in ids:
+            shard_of[id] = i
+    with open(source, 'rb') as f:
+        header = f.readline()
+        rows = [[header] for _ in shards]
+        for line in f:
+            i = shard_of.get(line.split(b'\t', 1)[0].strip().decode())
+            if i is not None:
+                rows[i].append(line)
+    return([b''.join(x) for x in rows])
+
+def build_shard(shard_dir, fasta, start, end, source_name, source_table, sbt_template, \
+    xml_template, spuid, compression_level):
+    """
+    Writes the zip and submission.xml for one shard, reading its records
+    from their byte range in the fasta.
+    """
+    os.makedirs(shard_dir, exist_ok=True)
+    zip_files(shard_dir, 'genbank.zip', [sbt_template], compression_level, \
+        {source_name: source_table}, {os.path.basename(fasta): (fasta, start, end)})
+    create_xml(shard_dir, 'genbank.zip', xml_template, spuid)
+    return(shard_dir)
+
+def build_shards(out_dir, fasta, source, sbt_template, xml_template, shards, \
+    compression_level=6, workers=4):
+    """
+    Splits the source table rows between the shards from plan_shards and
+    builds each shard's package in out_dir/shard_NNN with a pool of worker
+    processes. Each shard gets its own SPUID so it can be uploaded and
+    retried on its own.
+    """
+    from concurrent.futures import ProcessPoolExecutor
+
+    tables = split_source(source, shards)
+    today_date = datetime.today().strftime('%Y-%m-%d')
+    print("Building %s shards of up to %s sequences" %(len(shards), max(len(x[2]) for x in shards)))
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = []
+        for i, ((start, end, ids), table) in enumerate(zip(shards, tables), 1):
+            shard_dir = os.path.join(out_dir, "shard_%03d" %i)
+            spuid = "%s.sarscov2.%03d" %(today_date, i)
+            futures.append(executor.submit(build_shard, shard_dir, fasta, start, end, \
+                os.path.basename(source), table, sbt_template, xml_template, spuid, compression_level))
+        for future, (_, _, ids), table in zip(futures, shards, tables):
+            shard_dir = future.result()
+            missing = len(ids) - (table.count(b'\n') - 1)
+            print("%s: %s sequences%s" %(shard_dir, len(ids), \
+                ", %s without source rows" %missing if missing > 0 else ""))
+
+def main():
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument(
+        "-o",
+        "--out-dir",
+        type=str,
+        help="Path to output files for ncbi upload."
+    )
+
+    parser.add_argument(
+        "-f",
+        "--fasta",
+        type=str,
+        help="Fasta file with all sequences."
+    )
+
+    parser.add_argument(
+        '-t',
+        '--source',
+        default="source.src",
+        help="Path to the source table for the sequences"
+    )
+
+    parser.add_argument(
+        '-s',
+        '--sbt-template',
+        help="Path to sbt template"
+    )
+
+    parser.add_argument(
+        '-x',
+        '--xml-template',
+        help="Path to xml template"
+    )
+
+    parser.add_argument(
+        '-l',
+        '--compression-level',
+        type=int,
+        default=6,
+        choices=range(10),
+        help="Deflate level for the zip, 0 stores the files uncompressed"
+    )
+
+    parser.add_argument(
+        '--shard-size',
+        type=int,
+        default=0,
+        help="Sequences per submission, 0 puts them all in one"
+    )
+
+    parser.add_argument(
+        '-w',
+        '--workers',
+        type=int,
+        default=4,
+        help="Number of shards to build at once"
+    )
+
+    args = parser.parse_args()
+    out_dir = args.out_dir
+
+    os.makedirs(out_dir, exist_ok=True)
+    shards = plan_shards(args.fasta, args.shard_size)
+    #every sequence can be filtered out or fail QC, there's no package to send then
+    if len(shards) == 0:
+        print("No sequences in %s, nothing to package" %args.fasta)
+        return
+    if args.shard_size > 0:
+        build_shards(out_dir, args.fasta, args.source, args.sbt_template, args.xml_template, \
+            shards, args.compression_level, args.workers)
+    else:
+        #the source rows go through split_source too, so both paths drop the same rows
+        table = split_source(args.source, shards)[0]
+        zip_files(out_dir, 'genbank.zip', [args.fasta, args.sbt_template], args.compression_level, \
+            {os.path.basename(args.source): table})
+        create_xml(out_dir, 'genbank.zip', args.xml_template)
+
+if __name__ == "__main__":
+    main()
@@ -7,45 +7,41 @@ Script provides utility functions for the following:
 * Both at the same time.
 """
 
+import io
 import os
+import base64
+import shutil
+import hashlib
 import ast
-import sys
 import json
+import queue
+import re
 import pickle
-import ftplib
-import typing
-import requests
 import argparse
-import xmlschema
-import pandas as pd
-import lxml.etree as et
-from copy import copy
-from math import isnan
-from google.cloud import storage
 import time
+import threading
 from datetime import datetime
 
-# import credentials
-
 class Sample:
-    def __init__(self, sample_name):
+    """
+    A sample in a batch and how far it has got through submission.
+    The fields are fixed in __slots__, which keeps batches of thousands
+    of samples small and lets a batch be written out column by column.
+    """
+    __slots__ = ('sample_name', 'file_name', 'full_filepath', 'file_download_status', \
+        'action_type', 'biosample_status', 'sra_status', 'biosample_accession', 'sra_accession')
+    def __init__(self, sample_name, file_name="Not Found", full_filepath=None, \
+        file_download_status='Absent', action_type=None, biosample_status=None, sra_status=None, \
+        biosample_accession=None, sra_accession=None):
         self.sample_name = sample_name
-    def file_name(self, filename):
-        self.file_name = filename
-    def full_filepath(self, full_filepath):
+        self.file_name = file_name
         self.full_filepath = full_filepath
-    #refers to if we downloaded it
-    def file_download_status(self, file_download_status):
+        #refers to if we downloaded it
         self.file_download_status = file_download_status
-    def action_type(self, action_type):
         self.action_type = action_type
-    def biosample_status(self, biosample_status):
         self.biosample_status = biosample_status
-    def sra_status(self, sra_status):
-        sel.sra_status = sra_status
-    def biosample_accession(self, biosample_accession):
+        self.sra_status = sra_status
         self.biosample_accession = biosample_accession
-    def sra_accession(self, sra_accession):
         self.sra_accession = sra_accession
 
 def open_config_file(file_path : str ) -> dict:
@@ -67,7 +63,47 @@ def open_config_file(file_path : str ) -> dict:
     
     return(json_config)
     
-def format_xml(metadata_tsv : str, sample_objs : list, submission_xml_file : str , action_name : str,
+def index_metadata(metadata_location : str) -> dict:
+    """
+    Reads the metadata once and indexes the rows by sample_name, so
+    each batch can look up a sample without scanning the whole table.
+
+    Parameters
+    ----------
+    metadata_location : str
+        Location of metadata file.
+
+    Returns
+    -------
+    metadata_index : dict
+        Maps each sample_name to a dict of its non-null metadata
+        fields, in column order. Where a sample_name appears on more
+        than one row the first row is kept and the duplicates reported.
+    """
+    import pandas as pd
+    from build_meta import read_meta
+    metadata_df = read_meta(metadata_location)
+    columns = list(metadata_df.columns)
+
+    metadata_index = {}
+    duplicates = {}
+    for values in metadata_df.itertuples(index=False, name=None):
+        row = {k: v for k, v in zip(columns, values) if not pd.isna(v)}
+        sample_name = row.get('sample_name')
+        if sample_name is None:
+            continue
+        if sample_name in metadata_index:
+            duplicates[sample_name] = duplicates.get(sample_name, 1) + 1
+            continue
+        metadata_index[sample_name] = row
+
+    for sample_name, n_rows in duplicates.items():
+        print("Duplicate sample_name %s found on %s metadata rows, using the first" \
+            %(sample_name, n_rows))
+
+    return(metadata_index)
+
+def format_xml(metadata_index : dict, sample_objs : list, submission_xml_file : str , action_name : str,
     action_type : str, file_type : str, json_config : dict) -> list:
 
     """
@@ -76,12 +112,12 @@ def format_xml(metadata_tsv : str, sample_objs : list, submission_xml_file : str
 
     Parameters
     ---------
-    metadata_tsv : str
-        Full filepath to where the metadata tsv is stored.
+    metadata_index : dict
+        Metadata rows keyed by sample_name, as built by index_metadata.
     submission_xml_file : str
         Full filepath to where the base .xml file is stored.
     action_name : str
-        Dir where we're outputting the .xml file.
+        Dir where we're outputting the .xml file, the cwd if empty.
     action_type : str
         Defines the action block of the .xml file. Can be either bs or bs_sra.
     found_files : list
@@ -94,12 +130,10 @@ def format_xml(metadata_tsv : str, sample_objs : list, submission_xml_file : str
     succeeded_files : list
         Files we successfully wrote the .xml file.
     """
+    import lxml.etree as et
      
     return_sample_objs = []    
 
-    #load table but skip over the header
-    metadata_df = pd.read_csv(metadata_tsv) 
-    
     #load base submission template, wither for bs or bs.sra
     tree = et.parse(submission_xml_file)
     root = tree.getroot()
@@ -124,70 +158,239 @@ def format_xml(metadata_tsv : str, sample_objs : list, submission_xml_file : str
     actions = root.findall("Action")
     for a in actions:
         a.getparent().remove(a)
-    
-    
-    #we iterate and append to .xml files for each sample
-    for sample in sample_objs:
-        #if we are even trying to do sra and don't have a filename, we skip
-        if "sra" in action_type:
-            if str(sample.file_name) == "Not Found":
-                continue
-            if str(sample.file_download_status) == 'Absent':
+
+    #precompile the action blocks once, each sample only changes a few fields
+    if 'bs' in action_type:
+        bs_spuid = bs_action.find("AddData/Data/XmlContent/BioSample/SampleId/SPUID")
+        bs_identifier = bs_action.find("AddData/Identifier/SPUID")
+        bs_attributes = bs_action.find("AddData/Data/XmlContent/BioSample/Attributes")
+
+    if 'sra' in action_type:
+        sra_spuid = sra_action.find("AddFiles/AttributeRefId/RefId/SPUID")
+        sra_identifier = sra_action.find("AddFiles/Identifier/SPUID")
+        sra_filename = sra_action.find("AddFiles/File")
+
+        #the sra attributes are the same for every sample
+        sra_dict = json_config["sra"]
+        for k,v in sra_dict.items():
+            new_elem = et.Element("Attribute")
+            new_elem.set("name", k)
+            new_elem.text = str(v)
+            sra_action.find("AddFiles").insert(2, new_elem)
+
+    #serialize the document around a marker where the actions go, so the
+    #actions can be streamed in between without holding the whole tree
+    marker = et.Comment("actions")
+    root.append(marker)
+    head, tail = et.tostring(tree).split(et.tostring(marker))
+
+    #stream the submission out, only one action is held in memory at a time
+    with open(os.path.join(action_name, "submission.xml"), 'wb') as xf:
+        xf.write(head)
+        #we iterate and write out the action blocks for each sample
+        for sample in sample_objs:
+            #if we are even trying to do sra and don't have a filename, we skip
+            if "sra" in action_type:
+                if str(sample.file_name) == "Not Found":
+                    continue
+                if str(sample.file_download_status) == 'Absent':
+                    continue
+
+            row = metadata_index.get(sample.sample_name)
+            if row is None or 'gisaid_virus_name' not in row:
                 continue
-        
-        row = metadata_df.loc[metadata_df['sample_name'] == sample.sample_name]
-        row = row.iloc[0].dropna() 
-        if 'gisaid_virus_name' not in row:
+            if 'bs' in action_type:
+                #add in proper sample id
+                bs_spuid.text = str(sample.file_name)
+                bs_identifier.text = str(sample.file_name)
+
+                #add in the attributes defined in the metadata
+                added = []
+                for k,v in row.items():
+                    new_elem = et.Element("Attribute")
+                    new_elem.set("attribute_name", k)
+                    new_elem.text = str(v)
+                    bs_attributes.insert(-1,new_elem)
+                    added.append(new_elem)
+                xf.write(et.tostring(bs_action))
+
+                #reset the block for the next sample
+                for a in added:
+                    bs_attributes.remove(a)
+
+            if 'sra' in action_type:
+                #add in proper sample id
+                sra_spuid.text = str(sample.file_name)
+                sra_identifier.text = row['gisaid_virus_name']
+                sra_filename.attrib["file_path"] = str(sample.file_name) + '%s' %file_type
+                xf.write(et.tostring(sra_action))
+
+        xf.write(tail)
+
+class GCSStorage:
+    """
+    Files under a prefix in a google cloud bucket.
+
+    Parameters
+    ----------
+    credentials_path : str
+        Path to the credentials .json file that is used to connect to
+        the google cloud storage client.
+    bucket_name : str
+        The name of the bucket to access.
+    """
+    def __init__(self, credentials_path, bucket_name, user_project='andersen-lab-primary'):
+        from google.cloud import storage
+        client = storage.Client.from_service_account_json(credentials_path)
+        self.bucket = client.bucket(bucket_name, user_project=user_project)
+    def list_files(self, prefix):
+        """
+        Returns a dict of file basename to (size, base64 md5) under the prefix.
+        """
+        self.blobs = {}
+        files = {}
+        for blob in self.bucket.list_blobs(prefix=prefix):
+            filename = os.path.basename(blob.name)
+            self.blobs[filename] = blob
+            files[filename] = (blob.size, blob.md5_hash)
+        return(files)
+    def download(self, filename, local_path):
+        self.blobs[filename].download_to_filename(local_path)
+    def md5(self, filename):
+        return(self.blobs[filename].md5_hash)
+
+class LocalStorage:
+    """
+    Files under a prefix in a local or mounted directory, with the
+    same interface as GCSStorage.
+
+    Parameters
+    ----------
+    root_dir : str
+        The directory standing in for the bucket.
+    """
+    def __init__(self, root_dir):
+        self.root_dir = root_dir
+    def list_files(self, prefix):
+        """
+        Returns a dict of file basename to (size, base64 md5) under the prefix.
+        The md5 is left as None and only computed if a checksum is asked for.
+        """
+        self.prefix_dir = os.path.join(self.root_dir, prefix)
+        files = {}
+        for entry in os.scandir(self.prefix_dir):
+            if entry.is_file():
+                files[entry.name] = (entry.stat().st_size, None)
+        return(files)
+    def download(self, filename, local_path):
+        shutil.copyfile(os.path.join(self.prefix_dir, filename), local_path)
+    def md5(self, filename):
+        return(file_md5(os.path.join(self.prefix_dir, filename)))
+
+def file_md5(path : str) -> str:
+    """
+    Returns the base64 encoded md5 of a file, the form google cloud reports it in.
+    """
+    md5 = hashlib.md5()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024*1024), b''):
+            md5.update(chunk)
+    return(base64.b64encode(md5.digest()).decode())
+
+def has_sample_name(stem : str, sample_names : set) -> bool:
+    """
+    Whether any of the sample names appears in stem followed by an _, as
+    the gsutil pattern *<name>_* matched it.
+    """
+    for i, c in enumerate(stem):
+        if c == '_':
+            for j in range(i):
+                if stem[j:i] in sample_names:
+                    return(True)
+    return(False)
+
+def fetch_files(backend, prefix : str, local_download_dir : str, file_type : str, \
+    filename_list : list, workers : int = 8, verify_checksum : bool = False) -> list:
+    """
+    Downloads the files for the requested samples from a storage backend in a
+    thread pool, skipping those already downloaded.
+
+    Parameters
+    ----------
+    backend : GCSStorage or LocalStorage
+        Where the files are stored.
+    prefix : str
+        The folder in the backend to look in.
+    local_download_dir : str
+        Path the directory the files should be downloaded to.
+    file_type : str
+        File extension to try and download.
+    filename_list : list
+        The sample names to download files for, matched as gsutil matched
+        *<name>_*.<file_type>: the name anywhere in the filename, followed
+        by an _.
+    workers : int
+        The number of files to download at once.
+    verify_checksum : bool
+        Whether a local file also needs a matching md5 to be skipped,
+        otherwise a matching size is enough.
+
+    Returns
+    -------
+    downloaded : list
+        The filenames that were downloaded.
+    """
+    extension = '.' + file_type.lstrip('.')
+    sample_names = set(filename_list)
+    remote_files = backend.list_files(prefix)
+
+    to_fetch = []
+    skipped = 0
+    for filename, (size, md5) in remote_files.items():
+        if not filename.endswith(extension):
             continue
-        if 'bs' in action_type:
-            #deep copy the add data biosample section
-            action_copy = copy(bs_action)
-            
-            #add in proper sample id
-            spuid = action_copy.find("AddData/Data/XmlContent/BioSample/SampleId/SPUID")
-            spuid.text = str(sample.file_name)
-            
-            identifier = action_copy.find("AddData/Identifier/SPUID")
-            identifier.text = str(sample.file_name)
-
-            #add in the attributes defined in the metadata 
-            for k,v in row.items():
-                new_elem = et.Element("Attribute")
-                new_elem.set("attribute_name", k)
-                new_elem.text = str(v)
-                action_copy.find("AddData/Data/XmlContent/BioSample/Attributes").insert(-1,new_elem)    
-            root.append(action_copy)        
-
-        if 'sra' in action_type:
-            action_copy = copy(sra_action)
-            
-            #add in proper sample id
-            spuid = action_copy.find("AddFiles/AttributeRefId/RefId/SPUID")
-            spuid.text = str(sample.file_name)
-            
-            identifier = action_copy.find("AddFiles/Identifier/SPUID")
-           
-            identifier.text = row['gisaid_virus_name']  
-
-            sra_dict = json_config["sra"]
-            filename = action_copy.find("AddFiles/File")
-            filename.attrib["file_path"] = str(sample.file_name) + '%s' %file_type
-            
-            for k,v in sra_dict.items():
-                new_elem = et.Element("Attribute")
-                new_elem.set("name", k)
-                new_elem.text = str(v)
-                action_copy.find("AddFiles").insert(2, new_elem) 
-            root.append(action_copy)
-   
-     
-    #write the output .xml file
-    tree.write("submission.xml")
+        if not has_sample_name(filename[:-len(extension)], sample_names):
+            continue
+        local_path = os.path.join(local_download_dir, filename)
+        if os.path.isfile(local_path) and os.path.getsize(local_path) == size:
+            if not verify_checksum:
+                skipped += 1
+                continue
+            if md5 is None:
+                md5 = backend.md5(filename)
+            if file_md5(local_path) == md5:
+                skipped += 1
+                continue
+        to_fetch.append((filename, local_path))
+
+    print("%s files to download, %s already present" %(len(to_fetch), skipped))
+
+    def download(filename, local_path):
+        #download beside the target so a partial file never looks complete
+        start = time.time()
+        backend.download(filename, local_path + '.part')
+        os.replace(local_path + '.part', local_path)
+        elapsed = time.time() - start
+        size = os.path.getsize(local_path)
+        print("%s: %.1f MB in %.1fs (%.1f MB/s)" %(filename, size/1e6, elapsed, \
+            size/1e6/max(elapsed, 1e-6)))
+        return(size)
+
+    from concurrent.futures import ThreadPoolExecutor
+    start = time.time()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        sizes = list(executor.map(lambda x: download(*x), to_fetch))
+    elapsed = time.time() - start
+    print("Downloaded %.1f MB in %.1fs (%.1f MB/s)" %(sum(sizes)/1e6, elapsed, \
+        sum(sizes)/1e6/max(elapsed, 1e-6)))
+
+    return([x[0] for x in to_fetch])
 
 def google_cloud_bam(local_download_dir, credentials_path, file_type, filename_list, \
-    bucket_name, blob_name, multiprocess):
+    bucket_name, blob_name, multiprocess, storage_backend='gcs'):
     """
-    Downloads contents of a folder from a google cloud bucket to a local directory.    
+    Downloads the files for the requested samples from a google cloud bucket
+    (or a local directory standing in for one) to a local directory.
     Intended use is to retrieve bam files prior to SRA submission.
 
     Parameters
@@ -198,76 +401,227 @@ def google_cloud_bam(local_download_dir, credentials_path, file_type, filename_l
         Path to the credentials .json file that is used to connect to 
         the google cloud storage client.
     filename_list : list
-        Filenames to try and download, will override file_type is specified.
+        Sample names to download files for.
     file_type : str
         File extension to try and download.
     bucket_name : str
-        The name of the bucket to access.
+        The name of the bucket to access, or the root dir if local.
     blob_name : str
         The name of the folder to download.
     multiprocess : bool
-        Whether to multiprocess pull files or not.
+        Whether to pull several files at once or one at a time.
+    storage_backend : str
+        Either gcs or local.
     """
-    #multiprocess download files, use if >1000
+    if storage_backend == 'local':
+        backend = LocalStorage(bucket_name)
+    else:
+        backend = GCSStorage(credentials_path, bucket_name)
+
     if multiprocess:
-        if len(filename_list) > 0:
-            pass
-        else:
-            if file_type:
-                pass
-            else:
-                pass
-        with open('filenames.txt','w') as f:
-            for name in filename_list:
-                f.write('gs://%s/%s/*%s_*.%s' %(bucket_name, blob_name,name,file_type) + '\n')
-        cmd = 'cat filenames.txt | gsutil -m cp -n -I %s' %(local_download_dir)        
-        os.system(cmd)
-    
-    #download files one at a time, use if <1000
+        workers = 16
     else:
-        client = storage.Client.from_service_account_json(credentials_path) 
-        bucket = client.bucket(bucket_name, user_project='andersen-lab-primary')
-        blobs = bucket.list_blobs(prefix=blob_name)
-       
-        for blob in blobs:
-            filename = os.path.basename(blob.name)
-            blob.download_to_filename(os.path.join(local_download_dir,filename))
-       
-def ftp_connection(run_type, run_dir, sample_objs):
-    server = 'ftp-private.ncbi.nlm.nih.gov'
-    username = credentials.username
-    password = credentials.password
-        
-    ftp = ftplib.FTP(server, username, password)
-    ftp.set_debuglevel(1)
-    ftp.set_pasv(False)
+        workers = 1
+    return(fetch_files(backend, blob_name, local_download_dir, file_type, filename_list, workers))
+
+def open_ftp(server : str, port : int, username : str, password : str, remote_dir : str, \
+    passive : bool):
+    """
+    Opens an FTP session and moves into the remote directory.
+    """
+    import ftplib
+    ftp = ftplib.FTP()
+    ftp.connect(server, port)
+    ftp.login(username, password)
+    ftp.set_pasv(passive)
+    ftp.cwd(remote_dir)
+    return(ftp)
+
+def close_ftp(ftp):
+    """
+    Closes an FTP session, dropping it if the server has already gone.
+    """
+    import ftplib
+    try:
+        ftp.quit()
+    except ftplib.all_errors:
+        ftp.close()
+
+def read_upload_manifest(manifest_path : str) -> dict:
+    """
+    Reads the record of files that have already been transfered.
+
+    Parameters
+    ----------
+    manifest_path : str
+        Path to the .jsonl manifest, one completed transfer per line.
+
+    Returns
+    -------
+    uploaded : dict
+        Maps each local filepath to the (size, mtime) it had when it was sent.
+    """
+    uploaded = {}
+    if not os.path.isfile(manifest_path):
+        return(uploaded)
+    with open(manifest_path, 'r') as mfile:
+        for line in mfile:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                #a partial line from an interupted run
+                continue
+            uploaded[record['path']] = (record['size'], record['mtime'])
+    return(uploaded)
+
+def ftp_connection(run_type, run_dir, sample_objs, server='ftp-private.ncbi.nlm.nih.gov', port=21, \
+    username=None, password=None, connections=4, retries=3, passive=False, manifest_path=None):
+    """
+    Uploads the files for a batch and its submission.xml over a bounded pool
+    of FTP sessions, then writes submit.ready once every file is on the server.
+    Completed transfers are recorded in a local manifest so a rerun only sends
+    files that are new or have changed since.
+
+    Parameters
+    ----------
+    run_type : str
+        Either Test or Production, the folder under submit/ to upload to.
+    run_dir : str
+        The action_name dir holding submission.xml, also the remote folder name.
+    sample_objs : list
+        The sample objects in the batch, files are sent for those Present.
+    server : str
+        The FTP host.
+    port : int
+        The FTP port.
+    username : str
+        FTP username, read from credentials if not given.
+    password : str
+        FTP password, read from credentials if not given.
+    connections : int
+        The number of FTP sessions to upload over at once.
+    retries : int
+        The number of times to try each file before giving up.
+    passive : bool
+        Whether to use passive mode.
+    manifest_path : str
+        The resume manifest, defaults to upload_manifest.jsonl in run_dir.
+    """
+    import ftplib
+    if username is None or password is None:
+        import credentials
+        username = credentials.username
+        password = credentials.password
+    if manifest_path is None:
+        manifest_path = os.path.join(run_dir, 'upload_manifest.jsonl')
+
     #rework this to be more pythonic
     if run_type == 'Test':
-        ftp.cwd('submit/Test')
+        base_dir = 'submit/Test'
     if run_type == 'Production':
-        ftp.cwd('submit/Production')
+        base_dir = 'submit/Production'
+    remote_name = os.path.basename(os.path.normpath(run_dir))
+    remote_dir = base_dir + '/' + remote_name
 
-    if run_dir not in ftp.nlst(): 
-        ftp.mkd(run_dir)
-    ftp.cwd(run_dir)
     filenames = [str(x.full_filepath) for x in sample_objs if str(x.file_download_status)=='Present']
-    filenames.append(os.path.join(run_dir, 'submission.xml')) 
-    for i, filename_transfer in enumerate(filenames):
-        if i % 100 == 0:
-            print("%s of %s transfered" %(i, len(filenames)))
-        file_transfer = open(filename_transfer,'rb') 
-        filename_stored = os.path.basename(filename_transfer)    
-        if filename_stored not in ftp.nlst():
-            ftp.storbinary('STOR %s' %filename_stored, file_transfer)
-        file_transfer.close()
-        time.sleep(10)
+    filenames.append(os.path.join(run_dir, 'submission.xml'))
+
+    #list the remote folder once for the whole batch
+    ftp = open_ftp(server, port, username, password, base_dir, passive)
+    if remote_name not in ftp.nlst():
+        ftp.mkd(remote_name)
+    ftp.cwd(remote_name)
+    remote_files = set(os.path.basename(x) for x in ftp.nlst())
+    ftp.voidcmd('TYPE I')
+
+    uploaded = read_upload_manifest(manifest_path)
+    manifest = open(manifest_path, 'a')
+    manifest_lock = threading.Lock()
+
+    def record(filename, stat):
+        with manifest_lock:
+            manifest.write(json.dumps({'path': filename, 'size': stat.st_size, \
+                'mtime': stat.st_mtime}) + '\n')
+            manifest.flush()
+
+    def remote_size(filename_stored):
+        try:
+            return(ftp.size(filename_stored))
+        except ftplib.error_perm:
+            return(None)
+
+    to_send = []
+    for filename in filenames:
+        stat = os.stat(filename)
+        filename_stored = os.path.basename(filename)
+        if uploaded.get(filename) == (stat.st_size, stat.st_mtime):
+            continue
+        #sent by an earlier run that didn't get to record it
+        if filename_stored in remote_files and remote_size(filename_stored) == stat.st_size:
+            record(filename, stat)
+            continue
+        to_send.append((filename, stat))
+    close_ftp(ftp)
+    print("%s of %s files already transfered" %(len(filenames) - len(to_send), len(filenames)))
+
+    #each upload borrows a session from the pool, opened on first use
+    pool = queue.Queue()
+    for _ in range(connections):
+        pool.put(None)
+
+    def upload(filename, stat):
+        session = pool.get()
+        try:
+            for attempt in range(retries):
+                try:
+                    if session is None:
+                        session = open_ftp(server, port, username, password, remote_dir, passive)
+                    with open(filename, 'rb') as file_transfer:
+                        session.storbinary('STOR %s' %os.path.basename(filename), file_transfer)
+                    break
+                except ftplib.all_errors:
+                    if session is not None:
+                        session.close()
+                        session = None
+                    if attempt == retries - 1:
+                        raise
+            record(filename, stat)
+        finally:
+            pool.put(session)
+
+    from concurrent.futures import ThreadPoolExecutor
+    failed = []
+    try:
+        with ThreadPoolExecutor(max_workers=connections) as executor:
+            futures = {executor.submit(upload, f, st): f for f, st in to_send}
+            for i, future in enumerate(futures):
+                if i % 100 == 0:
+                    print("%s of %s transfered" %(i, len(to_send)))
+                try:
+                    future.result()
+                except ftplib.all_errors as e:
+                    print("Failed to transfer %s: %s" %(futures[future], e))
+                    failed.append(futures[future])
+    finally:
+        manifest.close()
+        while not pool.empty():
+            session = pool.get()
+            if session is not None:
+                close_ftp(session)
+
+    if len(failed) > 0:
+        raise RuntimeError("%s files failed to transfer, not writing submit.ready" %len(failed))
+
+    #confirm everything arrived before telling ncbi the submission is ready
+    ftp = open_ftp(server, port, username, password, remote_dir, passive)
+    remote_files = set(os.path.basename(x) for x in ftp.nlst())
+    missing = [x for x in filenames if os.path.basename(x) not in remote_files]
+    if len(missing) > 0:
+        close_ftp(ftp)
+        raise RuntimeError("%s files missing on the server, not writing submit.ready" %len(missing))
+    ftp.storbinary('STOR submit.ready', io.BytesIO(b''))
+    close_ftp(ftp)
 
-        
-    
-    file_transfer = open("submit.ready", "w").close()
-    file_transfer = open("submit.ready",'rb')
-    ftp.storbinary('STOR submit.ready', file_transfer)
-    
 def submission_xml(action_type : str, config_template :str , submission_format_output : str, \
     json_config : dict):
     """
@@ -286,6 +640,7 @@ def submission_xml(action_type : str, config_template :str , submission_format_o
     json_config : dict
         User set parameters for submission configuration.
     """
+    import lxml.etree as et
     
     #reconfigure this its dumb
     if 'sra' in action_type:
@@ -357,17 +712,203 @@ def submission_xml(action_type : str, config_template :str , submission_format_o
 
     tree.write("%s" %(submission_format_output))
 
-def validate(xml_path: str, xsd_path: str, verbose : bool) -> bool:
-    import xmlschema 
-    schema = xmlschema.XMLSchema(xsd_path)
+_schema_cache = {}
 
-    if verbose:
-        schema.validate(xml_path)
-    
-    results = schema.is_valid(xml_path)
+def load_schema(xsd_path : str, cache_dir : str = None):
+    """
+    Returns the compiled schema for an .xsd, compiling it only the first time.
+    Compiled schemas are kept for the life of the process and pickled to
+    cache_dir, keyed on the .xsd path and mtime, so later runs and worker
+    processes can skip compiling.
+
+    Parameters
+    ----------
+    xsd_path : str
+        Path to the .xsd file.
+    cache_dir : str
+        Where to keep pickled schemas, defaults to ~/.cache/post_inspection_pipeline.
+
+    Returns
+    -------
+    schema : xmlschema.XMLSchema
+        The compiled schema.
+    """
+    import xmlschema
+    xsd_path = os.path.abspath(xsd_path)
+    key = "%s:%s:%s" %(xsd_path, os.path.getmtime(xsd_path), xmlschema.__version__)
+    if key in _schema_cache:
+        return(_schema_cache[key])
+
+    if cache_dir is None:
+        cache_dir = os.path.join(os.path.expanduser('~'), '.cache', 'post_inspection_pipeline')
+    pickle_path = os.path.join(cache_dir, hashlib.sha1(key.encode()).hexdigest() + '.schema.pickle')
+    schema = None
+    if os.path.isfile(pickle_path):
+        try:
+            with open(pickle_path, 'rb') as pfile:
+                schema = pickle.load(pfile)
+        except Exception:
+            schema = None
+    if schema is None:
+        schema = xmlschema.XMLSchema(xsd_path)
+        try:
+            os.makedirs(cache_dir, exist_ok=True)
+            with open(pickle_path + '.%s' %os.getpid(), 'wb') as pfile:
+                pickle.dump(schema, pfile)
+            os.replace(pickle_path + '.%s' %os.getpid(), pickle_path)
+        except OSError:
+            pass
+
+    _schema_cache[key] = schema
+    return(schema)
+
+def _schema_errors(schema, source, offset : int = 0) -> list:
+    """
+    Validates a document in a single pass, returning (action index, message)
+    for each error. The index counts Action elements from 0 plus the offset,
+    or is None where the error is outside of an action.
+    """
+    errors = []
+    for error in schema.iter_errors(source):
+        path = str(error.path)
+        index = None
+        match = re.search(r'/Action(\[(\d+)\])?(?=/|$)', path)
+        if match:
+            index = int(match.group(2) or 1) - 1 + offset
+            #report the position in the whole document, not the chunk
+            path = path[:match.start()] + '/Action[%s]' %(index + 1) + path[match.end():]
+        errors.append((index, "%s: %s" %(path, error.reason)))
+    return(errors)
+
+def _action_spuid(action) -> str:
+    spuid = action.find(".//SPUID")
+    if spuid is None:
+        return(None)
+    return(spuid.text)
+
+def _validate_chunk(xsd_path : str, document : bytes, offset : int) -> list:
+    return(_schema_errors(load_schema(xsd_path), io.BytesIO(document), offset))
+
+def validation_errors(xml_path : str, xsd_path : str, workers : int = 1, chunk_size : int = 1000) -> dict:
+    """
+    Validates a submission .xml and groups the errors by sample.
+
+    Parameters
+    ----------
+    xml_path : str
+        Path to the submission .xml.
+    xsd_path : str
+        Path to the .xsd to validate against.
+    workers : int
+        Above 1, the Action elements are validated in chunks across this many
+        processes. Constraints spanning actions in different chunks aren't checked.
+    chunk_size : int
+        The number of Action elements per chunk.
+
+    Returns
+    -------
+    errors : dict
+        Maps the SPUID of each failing action, or submission for errors outside
+        the actions, to a list of error messages. Empty if the .xml is valid.
+    """
+    import lxml.etree as et
+    schema = load_schema(xsd_path)
+
+    found = None
+    spuids = None
+    if workers > 1:
+        tree = et.parse(xml_path)
+        root = tree.getroot()
+        actions = root.findall("Action")
+        spuids = [_action_spuid(a) for a in actions]
+
+        if len(actions) > chunk_size:
+            #rebuild the document around each chunk of actions
+            for a in actions:
+                root.remove(a)
+            marker = et.Comment("actions")
+            root.append(marker)
+            head, tail = et.tostring(tree).split(et.tostring(marker))
+
+            from concurrent.futures import ProcessPoolExecutor
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                futures = []
+                for offset in range(0, len(actions), chunk_size):
+                    chunk = b''.join(et.tostring(a) for a in actions[offset:offset+chunk_size])
+                    futures.append(executor.submit(_validate_chunk, xsd_path, head + chunk + tail, offset))
+                found = [e for f in futures for e in f.result()]
+
+    if found is None:
+        found = _schema_errors(schema, xml_path)
+        #only look up the sample ids if there's something to report
+        if len(found) > 0 and spuids is None:
+            spuids = []
+            for _, a in et.iterparse(xml_path, tag="Action"):
+                spuids.append(_action_spuid(a))
+                a.clear()
+
+    errors = {}
+    for index, message in found:
+        if index is None:
+            key = 'submission'
+        else:
+            key = spuids[index] or 'Action %s' %(index + 1)
+        if message not in errors.setdefault(key, []):
+            errors[key].append(message)
+    return(errors)
+
+def validate(xml_path: str, xsd_path: str, verbose : bool, workers : int = 1) -> bool:
+    """
+    Validates a submission .xml, reporting the errors for each sample.
+    If verbose the errors are printed and written to validation_errors.tsv
+    beside the .xml.
+    """
+    errors = validation_errors(xml_path, xsd_path, workers)
+
+    if verbose and len(errors) > 0:
+        error_path = os.path.join(os.path.dirname(xml_path), 'validation_errors.tsv')
+        with open(error_path, 'w') as efile:
+            efile.write("spuid\terror\n")
+            for spuid, messages in errors.items():
+                for message in messages:
+                    print("%s: %s" %(spuid, message))
+                    efile.write("%s\t%s\n" %(spuid, message.replace('\t', ' ').replace('\n', ' ')))
+        print("%s samples failed validation, see %s" %(len(errors), error_path))
+
+    results = len(errors) == 0
     return(results)
 
-def file_presence(file_dir, sample_objs, file_type, action_name):
+class DirSnapshot:
+    """
+    The names, sizes and mtimes of the files in a directory, read with a
+    single os.scandir so checking thousands of samples against it costs
+    no further filesystem calls.
+
+    Parameters
+    ----------
+    dir_path : str
+        The directory to list.
+    """
+    def __init__(self, dir_path):
+        self.dir_path = dir_path
+        self.files = {}
+        with os.scandir(dir_path) as entries:
+            for entry in entries:
+                if entry.is_file():
+                    stat = entry.stat()
+                    self.files[entry.name] = (stat.st_size, stat.st_mtime)
+        self._mappings = {}
+    def __contains__(self, filename):
+        return(filename in self.files)
+    def filename_mapping(self, file_type):
+        """
+        The build_filename_mapping of the listing, built once per file_type.
+        """
+        if file_type not in self._mappings:
+            self._mappings[file_type] = build_filename_mapping(list(self.files), file_type)
+        return(self._mappings[file_type])
+
+def file_presence(file_dir, sample_objs, file_type, action_name, snapshot=None):
     """
     Locates the files from the metadata and returns
     filenames that are found. If sample name mapping is needed
@@ -384,17 +925,22 @@ def file_presence(file_dir, sample_objs, file_type, action_name):
         The extension of the file used.
     action_name : str
         The name of the project to be used as an output dir.
+    snapshot : DirSnapshot
+        A listing of file_dir to check against, taken here if not given.
     
     Returns
     -------
     found_files : list
         List of files in the metadata that have been found locally.
     """
+    if snapshot is None:
+        snapshot = DirSnapshot(file_dir)
+
     return_sample_objs = []
     for sample in sample_objs:
         #if we have a filename we check for it 
         if str(sample.file_name) != "Not Found":
-            if os.path.exists(os.path.join(file_dir, str(sample.file_name)+file_type)):
+            if str(sample.file_name)+file_type in snapshot:
                 sample.file_download_status = 'Present'
                 sample.full_filepath = os.path.join(file_dir,str(sample.file_name)+file_type)
         else:
@@ -404,20 +950,9 @@ def file_presence(file_dir, sample_objs, file_type, action_name):
     
     return(return_sample_objs)
 
-def internal_filename_mapping(fasta_filenames, sample_objs, file_type):
+def build_filename_mapping(fasta_filenames, file_type):
     """
-    Takes two lists of files and tries to map the names to each other.
-    
-    Parameters
-    ----------
-    fasta_filenames : list
-    local_files : list
-    file_typ : str
-    
-    Returns
-    -------
-    return_sample_objs : list
-        List of sample objects that have been added to.
+    Maps each number in the filenames to the filename, minus the file_type.
     """
     fasta_filenames = [x.replace(file_type,"") for x in fasta_filenames]
     fasta_mapping = {}
@@ -431,6 +966,27 @@ def internal_filename_mapping(fasta_filenames, sample_objs, file_type):
         for c in components:
             if c.isdigit():
                 fasta_mapping[c] = filename
+    return(fasta_mapping)
+
+def internal_filename_mapping(fasta_filenames, sample_objs, file_type, fasta_mapping=None):
+    """
+    Takes two lists of files and tries to map the names to each other.
+    
+    Parameters
+    ----------
+    fasta_filenames : list
+    local_files : list
+    file_typ : str
+    fasta_mapping : dict
+        A prebuilt build_filename_mapping of fasta_filenames.
+    
+    Returns
+    -------
+    return_sample_objs : list
+        List of sample objects that have been added to.
+    """
+    if fasta_mapping is None:
+        fasta_mapping = build_filename_mapping(fasta_filenames, file_type)
     
     return_sample_objs = []    
     for sample in sample_objs:
@@ -447,24 +1003,6 @@ def internal_filename_mapping(fasta_filenames, sample_objs, file_type):
         return_sample_objs.append(sample)
     return(return_sample_objs) 
 
-def get_all_sample_names(metadata_location : str) -> list:
-    """
-    Takes in a metadata file and returns all the sample names.
-
-    Parameters
-    ----------
-    metadata_location : str
-        Location of metadata file.
-    
-    Returns
-    -------
-    all_sample_names : list
-        A list of all sample names in the metdata.
-    """
-    df = pd.read_csv(metadata_location)
-    all_sample_names = df['sample_name'].tolist()
-    return(all_sample_names)
-
 def define_batches(iterable, n=1):
     """
     Support function to create batches.
@@ -473,8 +1011,57 @@ def define_batches(iterable, n=1):
     for ndx in range(0, l, n):
         yield iterable[ndx:min(ndx + n, l)]
 
+def sample_file_sizes(sample_names : list, snapshot, file_type : str) -> list:
+    """
+    Returns the size in bytes of each sample's file in the snapshot,
+    0 where no file maps to the sample.
+    """
+    sample_objs = internal_filename_mapping(list(snapshot.files), \
+        [Sample(x) for x in sample_names], file_type, snapshot.filename_mapping(file_type))
+    sizes = []
+    for sample in sample_objs:
+        sizes.append(snapshot.files.get(str(sample.file_name)+file_type, (0, None))[0])
+    return(sizes)
+
+def plan_batches(sample_names : list, sizes : list, max_samples : int, max_bytes : int = None) -> list:
+    """
+    Splits the samples, in order, into batches that stay under both a sample
+    count and a total file size. A single sample larger than max_bytes gets
+    a batch to itself.
+
+    Parameters
+    ----------
+    sample_names : list
+        The samples to batch.
+    sizes : list
+        The file size of each sample in bytes.
+    max_samples : int
+        The most samples allowed in a batch.
+    max_bytes : int
+        The most bytes allowed in a batch, no limit if None.
+
+    Returns
+    -------
+    plan : list
+        A (start index, sample names, total bytes) tuple for each batch.
+    """
+    plan = []
+    start = 0
+    batch_bytes = 0
+    for i, size in enumerate(sizes):
+        n_samples = i - start
+        if n_samples > 0 and (n_samples >= max_samples or \
+            (max_bytes is not None and batch_bytes + size > max_bytes)):
+            plan.append((start, sample_names[start:i], batch_bytes))
+            start = i
+            batch_bytes = 0
+        batch_bytes += size
+    if start < len(sample_names):
+        plan.append((start, sample_names[start:], batch_bytes))
+    return(plan)
+
 def find_sample_names(sample_objs, file_type, download_files, local_download_dir, \
-    bucket_name, blob_name):
+    bucket_name, blob_name, snapshot=None):
     """
     Either check google cloud location for filenames or check
     local directory where the files are stored to map the sample names.
@@ -493,24 +1080,169 @@ def find_sample_names(sample_objs, file_type, download_files, local_download_dir
         The name of the bucket where files would be stored on google cloud.
     blob_name : str
         Name of the blob where files would be located on google cloud.
+    snapshot : DirSnapshot
+        A listing of local_download_dir to map against, taken here if not given.
     """
     if download_files:
         pass
     else:
-        all_potential_filenames = os.listdir(local_download_dir) 
-        sample_objs = internal_filename_mapping(all_potential_filenames, sample_objs, file_type)
+        if snapshot is None:
+            snapshot = DirSnapshot(local_download_dir)
+        sample_objs = internal_filename_mapping(list(snapshot.files), sample_objs, file_type, \
+            snapshot.filename_mapping(file_type))
     return(sample_objs)
 
 def dump_objects(out_dir, action_name, sample_objs):
-    with open(os.path.join(out_dir, action_name,"file_info.pickle"), 'wb') as pfile:
-        for obj in sample_objs:
-            pickle.dump(obj, pfile)
+    """
+    Writes the batch's sample objects to file_info.npz in the action_name
+    dir, with one array per Sample field.
+    """
+    import numpy as np
+    columns = {}
+    for field in Sample.__slots__:
+        values = [getattr(x, field) for x in sample_objs]
+        columns[field] = np.array(['' if x is None else str(x) for x in values], dtype=str)
+    np.savez_compressed(os.path.join(out_dir, action_name, "file_info.npz"), **columns)
+
+def load_objects(out_dir, action_name) -> list:
+    """
+    Reads the sample objects for a batch back from its file_info.npz.
+    Fields that were None are read back as None, all others as strings.
+    """
+    import numpy as np
+    with np.load(os.path.join(out_dir, action_name, "file_info.npz"), allow_pickle=False) as manifest:
+        columns = [manifest[field].tolist() for field in Sample.__slots__]
+    return([Sample(*[None if x == '' else x for x in values]) for values in zip(*columns)])
+
+def process_batch(count : int, sample_names : list, batch : int, n_batches : int, \
+    action_name : str, json_config : dict, metadata_index : dict, snapshot, xml_dir : str, \
+    validation_workers : int = 1) -> dict:
+    """
+    Maps, checks and writes the submission files for a single batch of samples.
+
+    Parameters
+    ----------
+    count : int
+        The index of this batch.
+    sample_names : list
+        The sample names in this batch.
+    batch : int
+        The batch size.
+    n_batches : int
+        The total number of batches, used for reporting.
+    action_name : str
+        The name of the batch, also used as its output dir.
+    json_config : dict
+        User set parameters for submission configuration.
+    metadata_index : dict
+        Metadata rows keyed by sample_name, as built by index_metadata.
+    snapshot : DirSnapshot
+        The listing of local_download_dir shared by every batch.
+    xml_dir : str
+        Dir to write submission_format.xml and submission.xml to, the cwd if empty.
+    validation_workers : int
+        The number of processes to validate the submission.xml across.
+
+    Returns
+    -------
+    summary : dict
+        The batch name, sample counts, validation result and the BioSample
+        and SRA SPUIDs of each sample present.
+    """
+    action_type = json_config['project_name']['action_type']
+    local_download_dir = json_config['file_download_info']['local_download_dir']
+    bucket_name = json_config['file_download_info']['bucket_name']
+    blob_name = json_config['file_download_info']['blob_name']
+    download_files = ast.literal_eval(json_config['file_download_info']['download_files'])
+    file_type = json_config['sra']['file_type']
+    metadata_location = json_config['file_download_info']['metadata_location']
+
+    #create list of sample objects
+    sample_objs = [Sample(sample_name) for sample_name in sample_names]
+
+    print("Beginning batch %s of %s" %(count, n_batches))
+
+    summary = {'action_name': action_name, 'samples': len(sample_objs), 'present': 0, 'valid': None, \
+        'spuids': {}, 'sra_spuids': {}}
+
+    #map samples names to filenames, prior to downloading from google cloud or anything else
+    sample_objs = find_sample_names(sample_objs, file_type, download_files, local_download_dir, \
+        bucket_name, blob_name, snapshot)
+
+    #check is this action name has been used before
+    action_dir = os.path.join(os.path.dirname(metadata_location), action_name)
+    os.makedirs(action_dir, exist_ok=True)
+
+    #if we're doing sra submission check for .bam file presence
+    sample_objs = file_presence(local_download_dir, sample_objs, file_type, action_name, snapshot)
+
+    #make sure the batch has some useable samples
+    summary['present'] = sum(x.file_download_status == 'Present' for x in sample_objs)
+    summary['spuids'] = {x.sample_name: str(x.file_name) for x in sample_objs if x.file_download_status == 'Present'}
+    #the sra action is identified by the virus name rather than the filename
+    summary['sra_spuids'] = {x: metadata_index[x]['gisaid_virus_name'] for x in summary['spuids'] \
+        if 'gisaid_virus_name' in metadata_index.get(x, {})}
+    if summary['present'] == 0:
+        return(summary)
+
+    #dump objects
+    dump_objects(os.path.dirname(metadata_location),action_name, sample_objs)
+
+    print("The total # of samples found is %s" %len(sample_objs))
+
+    valid_action_types = {'bs': 'bs.submission.xml', 'sra':'sra.submission.run.xml', 'bs_sra':'sra.submission.bs.run.xml'}
+
+    #formats the basics of the submission and action blocks
+    submission_format = os.path.join(xml_dir, "submission_format.xml")
+    submission_xml(action_type, valid_action_types[action_type], submission_format, json_config)
+
+    #format the xml file for submission
+    format_xml(metadata_index, sample_objs, submission_format, xml_dir, "bs_sra", \
+        file_type, json_config)
+
+    #validates the xml file and returns any problem areas
+    summary['valid'] = validate(os.path.join(xml_dir, "submission.xml"), \
+        "/home/alab/data/ncbi_batch_push/xml_package_template/submission_verification.xsd", True, \
+        validation_workers)
+
+    return(summary)
+
+_worker_state = {}
+
+def _init_worker(json_config, metadata_index, snapshot):
+    """
+    Keeps the run-wide config, metadata index and file listing in each pool worker,
+    so they're sent once per process rather than once per batch.
+    """
+    _worker_state['json_config'] = json_config
+    _worker_state['metadata_index'] = metadata_index
+    _worker_state['snapshot'] = snapshot
+
+def _process_batch_worker(count, sample_names, batch, n_batches, action_name, xml_dir):
+    return(process_batch(count, sample_names, batch, n_batches, action_name, \
+        _worker_state['json_config'], _worker_state['metadata_index'], _worker_state['snapshot'], \
+        xml_dir))
 
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument('config_filename')
+    parser.add_argument(
+        '-w',
+        '--workers',
+        type=int,
+        default=1,
+        help="Number of batches to build at once. Above 1 each batch's xml is written to its own action_name dir."
+    )
+    parser.add_argument(
+        '--validation-workers',
+        type=int,
+        default=1,
+        help="Number of processes to validate each batch's xml across, used when batches are built one at a time."
+    )
     args = parser.parse_args()
     config_filename = args.config_filename
+    workers = args.workers
+    validation_workers = args.validation_workers
     
     #parse json config file
     json_config = open_config_file(config_filename)
@@ -526,17 +1258,22 @@ def main():
     blob_name = json_config['file_download_info']['blob_name']
     multiprocess= ast.literal_eval(json_config['file_download_info']['multiprocess'])
     download_files = ast.literal_eval(json_config['file_download_info']['download_files'])
+    storage_backend = json_config['file_download_info'].get('storage_backend', 'gcs')
     file_type = json_config['sra']['file_type'] 
 
     metadata_location = json_config['file_download_info']['metadata_location']
     
-    #hard coded batch size if used
+    #batches are capped by sample count and, if set, by total file size
     if batch_submission:
-        batch = 8000
+        batch = ast.literal_eval(json_config['project_name'].get('batch_max_samples', '8000'))
     else:
         batch = 1
+    batch_max_bytes = ast.literal_eval(json_config['project_name'].get('batch_max_bytes', 'None'))
+    #read the metadata once, every batch looks its samples up in the index
+    metadata_index = index_metadata(metadata_location)
+
     if target_sample_names is None:
-        all_sample_names = get_all_sample_names(metadata_location)
+        all_sample_names = list(metadata_index)
     else:
         all_sample_names = target_sample_names
 
@@ -547,80 +1284,93 @@ def main():
     "SEARCH-5743-SAN"]
 
     all_sample_names = [item for item in all_sample_names if item not in reserve]  
+
+    #leave out samples the ledger has as already submitted or in a submission not yet reported on
+    ledger_path = json_config['file_download_info'].get('ledger_path')
+    if ledger_path is not None:
+        from ledger import open_ledger, fetch, DONE_STATUSES, IN_FLIGHT_STATUSES
+        conn = open_ledger(ledger_path)
+        done = set(x for x, y in fetch(conn, all_sample_names).items() \
+            if y['status'] in DONE_STATUSES + IN_FLIGHT_STATUSES)
+        all_sample_names = [item for item in all_sample_names if item not in done]
+        print("Skipping %s samples the ledger has as submitted or in flight" %len(done))
     # print(all_sample_names)
     now = datetime.now()
     dt_string = now.strftime("%Y-%m-%d")
 
-    #large loop to batch out sample
-    for count, sample_names in enumerate(define_batches(all_sample_names, batch)):
-        # if count <= 12:
-        #     continue
-        #create list of sample objects
-        sample_objs = [Sample(sample_name) for sample_name in sample_names]
-
-        print("Beginning batch %s of %s" %(count, round(len(all_sample_names)/batch)))
-
-        #define the batch start/end samples non-inclusive
-        start_batch = str(count*batch)
-        end_batch = str((count+1)*batch)
-        action_name = original_action_name + '_' + dt_string + '_' + start_batch + '_' + end_batch
-        
-        #map samples names to filenames, prior to downloading from google cloud or anything else
-        sample_objs = find_sample_names(sample_objs, file_type, download_files, local_download_dir, \
-            bucket_name, blob_name)
-        # print(os.path.join(os.path.dirname(metadata_location), action_name))
-        #check is this action name has been used before
-        if os.path.isdir(os.path.join(os.path.dirname(metadata_location), action_name)):
-            pass 
-        else:
-            os.system("mkdir %s" %os.path.join(os.path.dirname(metadata_location), action_name))    
+    #fetch files once for the whole run if it's an sra submission and they aren't local
+    if 'sra' in action_type and download_files:
+        google_cloud_bam(local_download_dir, credentials_path, file_type, all_sample_names,\
+            bucket_name, blob_name, multiprocess, storage_backend)
 
-        #this whole block can be reworked to accomodate SRA google cloud connection.
-        #fetch files if it's an sra submission and they aren't local
-        if 'sra' in action_type and download_files:
-            #first we get the bam files from google cloud   
-            google_cloud_bam(local_download_dir, credentials_path, file_type, all_sample_names,\
-                bucket_name, blob_name, multiprocess)
+    #list the files once, every batch checks its samples against the same listing
+    snapshot = DirSnapshot(local_download_dir)
 
-            #if we're doing sra submission check for .bam file presence
-        sample_objs = file_presence(local_download_dir, sample_objs, file_type, action_name)
+    #plan every batch up front from the file sizes
+    sizes = sample_file_sizes(all_sample_names, snapshot, file_type)
+    plan = plan_batches(all_sample_names, sizes, batch, batch_max_bytes)
+    n_batches = len(plan)
 
-        #checks the file download status
-        # sample_objs = file_presence(local_download_dir, sample_objs, file_type, action_name)
-        
-        one_useful_sample=False
-        #make sure the batch has some useable samples
-        for sample in sample_objs:
-            # print(str(sample.file_name))
-            if str(sample.file_download_status) == 'Present':
-                one_useful_sample=True
-                break
-        #     else:
-        #         print(sample.__dict__)
-        if not one_useful_sample:
-            continue            
-        #dump objects
-        dump_objects(os.path.dirname(metadata_location),action_name, sample_objs)
-                
-        print("The total # of samples found is %s" %len(sample_objs))
+    batch_args = []
+    plan_path = os.path.join(os.path.dirname(metadata_location), 'batch_plan.tsv')
+    with open(plan_path, 'w') as pfile:
+        pfile.write("action_name\tsamples\tbytes\n")
+        for count, (start, sample_names, batch_bytes) in enumerate(plan):
+            #define the batch start/end samples non-inclusive
+            start_batch = str(start)
+            end_batch = str(start + len(sample_names))
+            action_name = original_action_name + '_' + dt_string + '_' + start_batch + '_' + end_batch
 
-        valid_action_types = {'bs': 'bs.submission.xml', 'sra':'sra.submission.run.xml', 'bs_sra':'sra.submission.bs.run.xml'}
-        
-        #formats the basics of the submission and action blocks
-        submission_xml(action_type, valid_action_types[action_type], "submission_format.xml", json_config)
-        
-        #format the xml file for submission
-        format_xml(metadata_location, sample_objs, "submission_format.xml", action_name, "bs_sra", \
-            file_type, json_config)        
+            #batches built side by side can't share the cwd
+            if workers > 1:
+                xml_dir = os.path.join(os.path.dirname(metadata_location), action_name)
+            else:
+                xml_dir = ''
+            batch_args.append((count, sample_names, batch, n_batches, action_name, xml_dir))
 
-        #validates the xml file and returns any problem areas
-        results = validate("submission.xml", "/home/alab/data/ncbi_batch_push/xml_package_template/submission_verification.xsd", True)
-        
-        # sys.exit(0) 
-        #connects via ftp to ncbi and uploads the files in the xml 
-        # ftp_connection(submission_type, action_name, sample_objs)
+            pfile.write("%s\t%s\t%s\n" %(action_name, len(sample_names), batch_bytes))
+            print("Planned %s: %s samples, %.1f GB" %(action_name, len(sample_names), batch_bytes/1e9))
 
-if __name__ == "__main__":
-    main()
+    #large loop to batch out sample
+    summaries = []
+    if workers > 1:
+        from concurrent.futures import ProcessPoolExecutor
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, \
+            initargs=(json_config, metadata_index, snapshot)) as executor:
+            #start the largest batches first so the workers finish together
+            order = sorted(range(n_batches), key=lambda i: plan[i][2], reverse=True)
+            futures = {i: executor.submit(_process_batch_worker, *batch_args[i]) for i in order}
+            summaries = [futures[i].result() for i in range(n_batches)]
+    else:
+        for a in batch_args:
+            count, sample_names, batch, n_batches, action_name, xml_dir = a
+            summaries.append(process_batch(count, sample_names, batch, n_batches, action_name, \
+                json_config, metadata_index, snapshot, xml_dir, validation_workers))
 
+    print("Batch summary:")
+    for summary in summaries:
+        if summary['valid'] is None:
+            status = 'skipped, no files found'
+        elif summary['valid']:
+            status = 'valid'
+        else:
+            status = 'invalid'
+        print("%s: %s of %s samples present, %s" %(summary['action_name'], summary['present'], \
+            summary['samples'], status))
+    print("%s samples present across %s batches" %(sum(x['present'] for x in summaries), len(summaries)))
 
+    if ledger_path is not None:
+        from ledger import record
+        rows = []
+        for summary in summaries:
+            status = 'xml' if summary['valid'] else 'invalid'
+            rows += [{'sample_name': x, 'spuid': y, 'sra_spuid': summary['sra_spuids'].get(x), \
+                'batch': summary['action_name'], 'status': status} for x, y in summary['spuids'].items()]
+        record(conn, rows)
+        conn.close()
+
+    #connects via ftp to ncbi and uploads the files in the xml 
+    # ftp_connection(submission_type, action_name, sample_objs)
+
+if __name__ == "__main__":
+    main()
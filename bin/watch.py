@@ -0,0 +1,410 @@
+#!/usr/bin/env python
+
+"""
+Watches a bjorn folder and submits new samples as they appear, instead of
+rerunning the whole workflow after each release. Every cycle polls
+msa/consensus_sequences, bam_inspect, bam_white and gisaid_metadata.csv,
+works out which samples are new since the last cycle and sends up to
+--max-samples of them through the same steps the workflow runs: the
+metadata from build_meta.py, BAM staging and screening from prep_bam.py,
+write_config.py and submit_ncbi.py for the SRA, and the consensus QC and
+submit_genbank.py for GenBank. Each micro-batch gets its own folder under
+<out_dir>/watch and its own SPUIDs, and --upload-command is run on every
+folder that's ready to upload.
+
+The run parameters are read from a json with the same names as the params
+in template.config, and what has been sent is kept in watch_state.json in
+out_dir so restarts carry on where they left off.
+
+    watch.py params.json --interval 300 --upload-command 'ascp ... -d {folder} ...'
+"""
+
+import os
+import sys
+import json
+import time
+import fcntl
+import shlex
+import argparse
+import traceback
+import subprocess
+from datetime import datetime
+
+import numpy as np
+from build_meta import sra_metadata, genbank_source, write_meta
+from prep_bam import bam_sample, find_bams, stage_bams
+from convert_fasta_id import index_records, read_record, glob_order
+from consensus_qc import sequence_stats
+from submit_genbank import zip_files, create_xml
+
+#params passed on to write_config.py, in its argument order
+CONFIG_PARAMS = ['instrument_model', 'first_name', 'last_name', 'email', 'organization', \
+    'spuid_namespace', 'title', 'organism', 'organism_package', 'bioproject', 'library_layout']
+
+QC_DEFAULTS = {'qc_min_length': 20000, 'qc_max_n_fraction': 0.5, 'qc_max_ambiguous': 100}
+
+def file_stat(path):
+    """
+    The size and mtime of a file, or None if it's missing.
+    """
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return(None)
+    return([st.st_size, st.st_mtime_ns])
+
+def read_state(state_path):
+    """
+    Reads what earlier cycles sent, starting empty on the first run.
+    """
+    state = {'consensus': {}, 'inputs': {}, 'sra_done': [], 'sra_failed': {}, \
+        'genbank_done': [], 'genbank_failed': [], 'retry': False}
+    if os.path.exists(state_path):
+        with open(state_path) as f:
+            state.update(json.load(f))
+    return(state)
+
+def write_state(state_path, state):
+    """
+    Writes the state, replacing the old one only once it's complete.
+    """
+    tmp_path = state_path + '.%s.part' %os.getpid()
+    with open(tmp_path, 'w') as f:
+        json.dump(state, f)
+    os.replace(tmp_path, state_path)
+
+def scan_consensus(consensus_dir, state):
+    """
+    Brings the IDs of each consensus fasta up to date, re-indexing only the
+    files that are new or whose size or mtime changed. IDs from changed
+    files get another chance at QC.
+
+    Returns
+    -------
+    changed : bool
+        Whether any file was added, changed or removed.
+    """
+    known = state['consensus']
+    current = {}
+    if os.path.isdir(consensus_dir):
+        for filename in os.listdir(consensus_dir):
+            path = os.path.join(consensus_dir, filename)
+            if not filename.startswith('.') and os.path.isfile(path):
+                current[path] = file_stat(path)
+
+    changed = set(known) != set(current)
+    failed = set(state['genbank_failed'])
+    for path, stat in current.items():
+        if path not in known or known[path]['stat'] != stat:
+            ids = list(index_records(path))
+            failed -= set(ids)
+            known[path] = {'stat': stat, 'ids': ids}
+            changed = True
+    for path in set(known) - set(current):
+        del known[path]
+    state['genbank_failed'] = sorted(failed)
+    return(changed)
+
+def consensus_locations(state, ids):
+    """
+    Finds the file and offset of each ID's sequence, as convert_fasta_id.py
+    would merge the folder: in glob order, the last record of an ID winning.
+    """
+    wanted = set(ids)
+    files = [x for x in glob_order(state['consensus']) if wanted & set(state['consensus'][x]['ids'])]
+    locations = {}
+    for path in files:
+        for id, offset in index_records(path).items():
+            if id in wanted:
+                locations[id] = (path, offset)
+    return(locations)
+
+def submission_samples(xml_path):
+    """
+    The samples with an SRA action in a submission.xml, from the BioSample
+    SPUIDs, the BAM filenames, the actions refer to.
+    """
+    import xml.etree.ElementTree as ET
+    root = ET.parse(xml_path).getroot()
+    return(sorted(set(bam_sample(x.text.strip()) for x in \
+        root.iterfind('Action/AddFiles/AttributeRefId/RefId/SPUID') if x.text)))
+
+def run_sra(batch_dir, meta, params, bjorn_folder, stamp):
+    """
+    Stages, screens and builds the SRA submission for a micro-batch. Raises
+    a RuntimeError if the submission.xml fails validation.
+
+    Returns
+    -------
+    bam_folder : str
+        The folder ready to upload, or None if nothing in the batch could be sent.
+    sent : list
+        The samples in the submission.xml.
+    failed : list
+        The BAMs that failed screening.
+    """
+    meta_path = os.path.join(batch_dir, 'ncbi_metadata.csv')
+    write_meta(meta, meta_path)
+    bam_folder = os.path.join(batch_dir, 'sra_%s' %stamp)
+    os.makedirs(bam_folder, exist_ok=True)
+    staged, missing, extra, failed = stage_bams(set(meta['sample_name']), bam_folder, \
+        [os.path.join(bjorn_folder, 'bam_inspect'), os.path.join(bjorn_folder, 'bam_white')])
+    if len(staged) == 0:
+        return(None, [], failed)
+
+    config_args = [str(params[x]) for x in CONFIG_PARAMS]
+    if params.get('ledger'):
+        config_args.append(params['ledger'])
+    subprocess.run(['write_config.py', meta_path, bam_folder] + config_args, cwd=batch_dir, check=True)
+    subprocess.run(['submit_ncbi.py', 'job_config.json'], cwd=batch_dir, check=True)
+    #submit_ncbi.py exits 0 when the xml doesn't validate, it only writes the errors out
+    if os.path.exists(os.path.join(batch_dir, 'validation_errors.tsv')):
+        raise RuntimeError("submission.xml failed validation, see %s" \
+            %os.path.join(batch_dir, 'validation_errors.tsv'))
+    xml_path = os.path.join(bam_folder, 'submission.xml')
+    os.replace(os.path.join(batch_dir, 'submission.xml'), xml_path)
+    sent = submission_samples(xml_path)
+    if len(sent) == 0:
+        return(None, sent, failed)
+    return(bam_folder, sent, failed)
+
+def run_genbank(batch_dir, meta, locations, params, stamp):
+    """
+    Writes the consensus sequences of a micro-batch, QCs them and builds
+    its GenBank zip and submission.xml with a SPUID of its own.
+
+    Returns
+    -------
+    genbank_folder : str
+        The folder ready to upload, or None if no sequence passed QC.
+    passed, failed : list
+        The IDs that passed and failed QC.
+    """
+    qc = dict(QC_DEFAULTS, **{x: params[x] for x in QC_DEFAULTS if x in params})
+    ids = [x for x in meta['sample_name'] if x in locations]
+    seqs = [read_record(*locations[x]) for x in ids]
+    lengths, n_counts, other_counts = sequence_stats(seqs)
+    passed = (lengths >= float(qc['qc_min_length'])) \
+        & (n_counts / np.maximum(lengths, 1) <= float(qc['qc_max_n_fraction'])) \
+        & (other_counts <= float(qc['qc_max_ambiguous']))
+    passed_ids = [x for x, y in zip(ids, passed) if y]
+    failed_ids = [x for x, y in zip(ids, passed) if not y]
+    if len(passed_ids) == 0:
+        return(None, passed_ids, failed_ids)
+
+    genbank_folder = os.path.join(batch_dir, 'genbank_%s' %stamp)
+    os.makedirs(genbank_folder, exist_ok=True)
+    fasta = os.path.join(batch_dir, 'sequences.fsa')
+    with open(fasta, 'wb') as f:
+        for id, seq, ok in zip(ids, seqs, passed):
+            if ok:
+                f.write(b">%s\n%s\n" %(id.encode(), seq))
+    source = os.path.join(batch_dir, 'source.src')
+    genbank_source(meta[meta['sample_name'].isin(set(passed_ids))]).to_csv(source, sep="\t", index=False)
+
+    zip_files(genbank_folder, 'genbank.zip', [fasta, source, params['sbt_template']])
+    create_xml(genbank_folder, 'genbank.zip', params['xml_template'], \
+        "%s.sarscov2.%s" %(datetime.today().strftime('%Y-%m-%d'), stamp))
+    return(genbank_folder, passed_ids, failed_ids)
+
+def upload(command, folder):
+    """
+    Runs the upload command on a folder, then adds submit.ready and runs it
+    again, as UPLOAD_FILES does, so NCBI only starts on the folder once
+    every file is there. Returns whether both uploads worked.
+    """
+    if command is None:
+        return(True)
+    for i in range(2):
+        if i == 1:
+            open(os.path.join(folder, 'submit.ready'), 'w').close()
+        result = subprocess.run(command.format(folder=shlex.quote(folder)), shell=True)
+        if result.returncode != 0:
+            print("Upload of %s failed with exit code %s" %(folder, result.returncode))
+            return(False)
+    return(True)
+
+def mark_submission(params, xml_path, status):
+    """
+    Sets the ledger status of the samples in a submission.xml, if the run
+    keeps a ledger.
+    """
+    if not params.get('ledger'):
+        return
+    from ledger import open_ledger, record, submission_samples
+    conn = open_ledger(params['ledger'])
+    record(conn, [{'sample_name': x, 'status': status} for x in submission_samples(conn, xml_path)])
+    conn.close()
+
+def cycle(params, state, max_samples, upload_command=None, force=False):
+    """
+    Runs one poll of the bjorn folder, sending at most max_samples new
+    samples to each of the SRA and GenBank. If a step or upload fails,
+    state['retry'] is set so the next cycle runs even if nothing changed.
+
+    Returns
+    -------
+    backlog : bool
+        Whether new samples were left for the next cycle.
+    """
+    bjorn_folder = params['bjorn_folder']
+    gisaid_meta_fp = os.path.join(bjorn_folder, 'gisaid_metadata.csv')
+
+    changed = scan_consensus(os.path.join(bjorn_folder, 'msa', 'consensus_sequences'), state)
+    bams = find_bams([os.path.join(bjorn_folder, 'bam_inspect'), os.path.join(bjorn_folder, 'bam_white')])
+    bam_stats = {x: file_stat(y[0]) for x, y in bams.items()}
+    inputs = {'gisaid': file_stat(gisaid_meta_fp), 'metadata': file_stat(params['metadata']), 'bams': bam_stats}
+    changed = changed or inputs != state['inputs']
+    if not changed and not force and not state['retry']:
+        return(False)
+    state['inputs'] = inputs
+    state['retry'] = False
+
+    #a failed step or upload leaves its samples unsent and flags a retry, so
+    #they're tried again next cycle even if the bjorn folder hasn't changed
+    try:
+        if 'author_conversions' in params:
+            meta = sra_metadata(gisaid_meta_fp, params['bioproject'], params['metadata'], \
+                params['author_conversions'])
+        else:
+            meta = sra_metadata(gisaid_meta_fp, params['bioproject'], params['metadata'])
+    except Exception:
+        print("Metadata conversion failed:")
+        traceback.print_exc()
+        state['retry'] = True
+        return(False)
+    meta = meta.drop_duplicates('sample_name')
+
+    #BAMs that failed screening are only retried once they change
+    bam_samples = set()
+    failed_bams = state['sra_failed']
+    for filename, stat in bam_stats.items():
+        if filename not in failed_bams or failed_bams[filename] != stat:
+            bam_samples.add(bam_sample(filename))
+    sra_done = set(state['sra_done'])
+    sra_new = [x for x in meta['sample_name'] if x in bam_samples and x not in sra_done]
+
+    consensus_ids = set(y for x in state['consensus'].values() for y in x['ids'])
+    genbank_skip = set(state['genbank_done']) | set(state['genbank_failed'])
+    genbank_new = [x for x in meta['sample_name'] if x in consensus_ids and x not in genbank_skip]
+    print("%s new SRA samples and %s new GenBank sequences" %(len(sra_new), len(genbank_new)))
+    if len(sra_new) == 0 and len(genbank_new) == 0:
+        return(False)
+
+    #the stamp names the micro-batch and its SPUIDs, so two cycles can't share one
+    while True:
+        stamp = datetime.now().strftime('%Y%m%d%H%M%S')
+        batch_dir = os.path.join(params['out_dir'], 'watch', stamp)
+        try:
+            os.makedirs(batch_dir)
+            break
+        except FileExistsError:
+            time.sleep(1)
+
+    failed_step = False
+    if len(sra_new) > 0:
+        batch = sra_new[:max_samples]
+        try:
+            bam_folder, sent, failed = run_sra(batch_dir, meta[meta['sample_name'].isin(set(batch))], \
+                params, bjorn_folder, stamp)
+            for filename in failed:
+                failed_bams[filename] = bam_stats.get(filename)
+            if bam_folder is not None:
+                #submit_ncbi.py leaves them as xml, which later runs skip as in flight
+                xml_path = os.path.join(bam_folder, 'submission.xml')
+                if upload(upload_command, bam_folder):
+                    state['sra_done'] = sorted(sra_done | set(sent))
+                    mark_submission(params, xml_path, 'uploaded')
+                else:
+                    mark_submission(params, xml_path, 'pending')
+                    failed_step = True
+        except Exception:
+            print("SRA micro-batch %s failed:" %stamp)
+            traceback.print_exc()
+            failed_step = True
+
+    if len(genbank_new) > 0:
+        batch = genbank_new[:max_samples]
+        try:
+            genbank_folder, passed, failed = run_genbank(batch_dir, meta[meta['sample_name'].isin(set(batch))], \
+                consensus_locations(state, batch), params, stamp)
+            state['genbank_failed'] = sorted(set(state['genbank_failed']) | set(failed))
+            if genbank_folder is not None:
+                if upload(upload_command, genbank_folder):
+                    state['genbank_done'] = sorted(set(state['genbank_done']) | set(passed))
+                else:
+                    failed_step = True
+        except Exception:
+            print("GenBank micro-batch %s failed:" %stamp)
+            traceback.print_exc()
+            failed_step = True
+
+    state['retry'] = failed_step
+    return(len(sra_new) > max_samples or len(genbank_new) > max_samples)
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('params', help="Json of the run parameters, named as in template.config.")
+    parser.add_argument(
+        '-i',
+        '--interval',
+        type=float,
+        default=300,
+        help="Seconds between polls when there's no backlog."
+    )
+    parser.add_argument(
+        '-n',
+        '--max-samples',
+        type=int,
+        default=200,
+        help="Most samples sent to each of the SRA and GenBank per cycle."
+    )
+    parser.add_argument(
+        '-u',
+        '--upload-command',
+        help="Shell command run on each folder ready to upload, with {folder} for its path. It's run \
+            again once submit.ready is added, and samples only count as sent once both succeed."
+    )
+    parser.add_argument(
+        '--once',
+        action='store_true',
+        help="Run a single cycle and exit."
+    )
+    args = parser.parse_args()
+
+    with open(args.params) as f:
+        params = json.load(f)
+    os.makedirs(params['out_dir'], exist_ok=True)
+    state_path = os.path.join(params['out_dir'], 'watch_state.json')
+
+    #one watcher per out_dir
+    lock = open(state_path + '.lock', 'w')
+    try:
+        fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        sys.exit("Another watcher is already running on %s" %params['out_dir'])
+
+    state = read_state(state_path)
+    force = True
+    try:
+        while True:
+            #anything the steps don't catch, such as an unreadable bjorn folder, is retried next cycle
+            try:
+                backlog = cycle(params, state, args.max_samples, args.upload_command, force)
+            except Exception:
+                print("Cycle failed:")
+                traceback.print_exc()
+                state['retry'] = True
+                backlog = False
+            write_state(state_path, state)
+            #carry on straight away while there's a backlog
+            force = backlog
+            if args.once:
+                break
+            if not backlog:
+                time.sleep(args.interval)
+    except KeyboardInterrupt:
+        write_state(state_path, state)
+
+if __name__ == "__main__":
+    main()
@@ -16,6 +16,8 @@ organism = sys.argv[10]
 package = sys.argv[11]
 bioproject = sys.argv[12]
 library_layout = sys.argv[13]
+#optional submission ledger, samples it has as submitted or in flight are left out
+ledger_path = sys.argv[14] if len(sys.argv) > 14 else None
 
 def write_ncbi_config():
     """
@@ -26,7 +28,9 @@ def write_ncbi_config():
         "action_name": "hcov-19_submission",
         "action_type": "bs_sra",
         "submission_type": "Production",
-        "batch_submission": "True"},
+        "batch_submission": "True",
+        "batch_max_samples": "8000",
+        "batch_max_bytes": "None"},
         "file_download_info": {
             "local_download_dir": bam_folder,
             "credentials_path": "/home/chrissy/ncbi_batch_push/andersen-lab-primary-4009c7fb6054.json",
@@ -35,7 +39,8 @@ def write_ncbi_config():
             "multiprocess": "True",
             "download_files": "False",
             "metadata_location": meta,
-            "target_sample_names": "None"
+            "target_sample_names": "None",
+            "ledger_path": ledger_path
         },
 
         "submission": {
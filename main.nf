@@ -2,13 +2,13 @@
 nextflow.enable.dsl=2
 
 include { POST_INSPECTION } from './modules/post_inspection.nf'
-include { PREP_SRA_META; PREP_SRA_FILES; UPLOAD_FILES } from './modules/sra.nf'
-include { CREATE_TABLE; CREATE_FSA; ZIP_FILES; UPLOAD_GENBANK } from './modules/genbank.nf'
+include { PREP_SRA_META; PREP_SRA_FILES; UPLOAD_FILES; MARK_UPLOADED } from './modules/sra.nf'
+include { CREATE_FSA; ZIP_FILES; UPLOAD_GENBANK } from './modules/genbank.nf'
 
 workflow {
-    PREP_SRA_META('start') | PREP_SRA_FILES | UPLOAD_FILES
+    PREP_SRA_META('start')
+    PREP_SRA_FILES(PREP_SRA_META.out.meta) | UPLOAD_FILES | MARK_UPLOADED
     CREATE_FSA()
-    CREATE_TABLE(PREP_SRA_META.out)
-    ZIP_FILES(CREATE_FSA.out, CREATE_TABLE.out)
+    ZIP_FILES(CREATE_FSA.out.fasta, PREP_SRA_META.out.source)
     UPLOAD_GENBANK(ZIP_FILES.out, params.aspera, params.ssh_key)
 }
\ No newline at end of file
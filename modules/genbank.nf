@@ -1,26 +1,17 @@
-process CREATE_TABLE {
-    input:
-    path sra_meta
-
-    output:
-    path("source.src")
-
-    shell:
-    '''
-    genbank.py -s !{sra_meta}
-    '''
-}
-
 process CREATE_FSA {
+    publishDir "${params.out_dir}", mode: 'copy', pattern: '{consensus_qc.tsv,sequences.fail.fsa}'
+
     output:
-    path("sequences.reformat.fsa")
+    path("sequences.pass.fsa"), emit: fasta
+    path("consensus_qc.tsv"), emit: qc
+    path("sequences.fail.fsa"), emit: failed
 
     shell:
     '''
-    for f in !{params.bjorn_folder}/msa/consensus_sequences/*; do
-        cat $f >> sequences.fasta
-    done
-    convert_fasta_id.py sequences.fasta
+    step_cache.py -i !{params.bjorn_folder}/msa/consensus_sequences -o sequences.reformat.fsa -- \
+        convert_fasta_id.py !{params.bjorn_folder}/msa/consensus_sequences
+    consensus_qc.py sequences.reformat.fsa --min-length !{params.qc_min_length} \
+        --max-n-fraction !{params.qc_max_n_fraction} --max-ambiguous !{params.qc_max_ambiguous}
     '''
 }
 
@@ -35,11 +26,23 @@ process ZIP_FILES {
     shell:
     date = new Date().format("yyyy-MM-dd")
     '''
-    submit_genbank.py -o ./ -f !{sequences} -s !{params.sbt_template} -x !{params.xml_template}
+    # source.src only has samples not yet in GenBank, drop the sequences of the rest too
+    ledger.py !{params.out_dir}/submission_ledger.sqlite filter-fasta !{sequences}
+    step_cache.py -i !{sequences} -i !{source} -i !{params.sbt_template} -i !{params.xml_template} \
+        -p !{date} -o genbank -- \
+        submit_genbank.py -o genbank -f !{sequences} -t !{source} -s !{params.sbt_template} \
+        -x !{params.xml_template} --shard-size !{params.genbank_shard_size}
     genbank_folder=!{params.out_dir}/genbank_!{params.out_folder}
     mkdir -p $genbank_folder
-    cp *.zip $genbank_folder
-    cp submission.xml $genbank_folder
+    if ls -d genbank/shard_* > /dev/null 2>&1; then
+        cp -r genbank/shard_* $genbank_folder
+    elif [ -f genbank/submission.xml ]; then
+        cp genbank/*.zip $genbank_folder
+        cp genbank/submission.xml $genbank_folder
+    else
+        echo "No sequences left for GenBank, nothing to upload"
+    fi
+    checksum_manifest.py $genbank_folder -m !{params.out_dir}/checksums_genbank.tsv
     '''
 }
 
@@ -53,8 +56,23 @@ process UPLOAD_GENBANK {
 
     shell: 
     '''
-    !{aspera}/ascp -i !{ssh_key} -QT -l100m -k1 -d !{genbank_folder} asp-search@upload.ncbi.nlm.nih.gov:!{params.aspera_folder}
-    touch !{genbank_folder}/submit.ready
-    !{aspera}/ascp -i !{ssh_key} -QT -l100m -k1 -d !{genbank_folder} asp-search@upload.ncbi.nlm.nih.gov:!{params.aspera_folder}
+    # each shard is its own submission, uploaded and marked ready separately
+    if ls -d !{genbank_folder}/shard_* > /dev/null 2>&1; then
+        folders=$(ls -d !{genbank_folder}/shard_*)
+        dest=!{params.aspera_folder}/$(basename !{genbank_folder})
+    else
+        folders=!{genbank_folder}
+        dest=!{params.aspera_folder}
+    fi
+    for folder in $folders; do
+        # an empty folder means every sequence was filtered out or failed QC
+        if [ ! -f $folder/submission.xml ]; then
+            echo "No GenBank package in $folder, skipping upload"
+            continue
+        fi
+        !{aspera}/ascp -i !{ssh_key} -QT -l100m -k1 -d $folder asp-search@upload.ncbi.nlm.nih.gov:$dest
+        touch $folder/submit.ready
+        !{aspera}/ascp -i !{ssh_key} -QT -l100m -k1 -d $folder asp-search@upload.ncbi.nlm.nih.gov:$dest
+    done
     '''
 }
\ No newline at end of file
@@ -1,5 +1,5 @@
 process PREP_SRA_FILES {
-    publishDir "${params.out_dir}", mode: 'link', pattern: 'submission.xml'
+    publishDir "${params.out_dir}", mode: 'link', pattern: '{submission.xml,bam_staging.tsv}'
     input:
     path meta
 
@@ -15,29 +15,34 @@ process PREP_SRA_FILES {
     ascp=!{params.aspera}
     ssh_key=!{params.ssh_key}
     mkdir -p $bam_folder
-    if [ "$(ls -A !{params.bjorn_folder}/bam_inspect/)" ]; then ln !{params.bjorn_folder}/bam_inspect/*.bam ${bam_folder}; fi
-    if [ "$(ls -A !{params.bjorn_folder}/bam_white/)" ]; then ln !{params.bjorn_folder}/bam_white/*.bam ${bam_folder}; fi
-    prep_bam.py !{meta} ${bam_folder}
+    prep_bam.py !{meta} ${bam_folder} !{params.bjorn_folder}/bam_inspect !{params.bjorn_folder}/bam_white \
+        --ledger !{params.out_dir}/submission_ledger.sqlite
     write_config.py !{meta} ${bam_folder} !{params.instrument_model} !{params.first_name} \
         !{params.last_name} !{params.email} !{params.organization} !{params.spuid_namespace} \
         !{params.title} !{params.organism} !{params.organism_package} !{params.bioproject} \
-        !{params.library_layout}
+        !{params.library_layout} !{params.out_dir}/submission_ledger.sqlite
     submit_ncbi.py job_config.json
     cp submission.xml $bam_folder
+    checksum_manifest.py ${bam_folder} -m !{params.out_dir}/checksums_sra.tsv
     '''
 }
 
 process PREP_SRA_META {
-    publishDir "${params.out_dir}", mode: 'link'
+    publishDir "${params.out_dir}", mode: 'link', pattern: 'ncbi_metadata.csv'
     input:
     val start
 
     output:
-    path "ncbi_metadata.csv"
+    path "ncbi_metadata.csv", emit: meta
+    path "source.src", emit: source
 
     shell:
     '''
-    convert_meta.py !{params.bjorn_folder}/gisaid_metadata.csv !{params.bioproject} !{params.metadata}
+    step_cache.py -i !{params.bjorn_folder}/gisaid_metadata.csv -i !{params.metadata} \
+        -i /home/alab/code/bjorn_utils/author_conversions.csv -o ncbi_metadata.csv -o source.src -- \
+        build_meta.py !{params.bjorn_folder}/gisaid_metadata.csv !{params.bioproject} !{params.metadata}
+    ledger.py !{params.out_dir}/submission_ledger.sqlite filter-meta ncbi_metadata.csv source.src \
+        -m !{params.metadata}
     '''
 }
 
@@ -48,10 +53,25 @@ process UPLOAD_FILES {
     path aspera
     path ssh_key
 
+    output:
+    env submission_xml
+
     shell: 
     '''
     !{aspera}/ascp -i !{ssh_key} -QT -l100m -k1 -d !{bam_folder} asp-search@upload.ncbi.nlm.nih.gov:!{params.aspera_folder}
     touch !{bam_folder}/submit.ready
     !{aspera}/ascp -i !{ssh_key} -QT -l100m -k1 -d !{bam_folder} asp-search@upload.ncbi.nlm.nih.gov:!{params.aspera_folder}
+    submission_xml=!{params.out_dir}/sra_!{params.out_folder}/submission.xml
+    '''
+}
+
+process MARK_UPLOADED {
+    input:
+    val submission_xml
+
+    shell:
+    '''
+    # the ascp container has no python, so the ledger is updated once the upload is done
+    ledger.py !{params.out_dir}/submission_ledger.sqlite mark uploaded --submission !{submission_xml}
     '''
 }